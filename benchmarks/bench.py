@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+# Benchmarks ovmfvartool against synthetic variable stores and reports the
+# results as JSON, so that they can be kept and compared across versions.
+#
+#   python3 benchmarks/bench.py --count 100 1000 --deleted-ratio 0 0.5 > new.json
+#   python3 benchmarks/bench.py --compare old.json > new.json
+#
+# The ovmfvartool in this tree is benchmarked, not any installed copy.
+import sys, os, io, argparse, contextlib, datetime, itertools, json, platform
+import random, resource, statistics, tempfile, time, tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ovmfvartool
+
+# The 528 KiB and 128 KiB layouts are the ones built by OVMF for 4 MiB and
+# 2 MiB flash images; "4mib" is a store taking up a whole 4 MiB volume, to see
+# how things scale with much larger stores.
+GEOMETRIES = dict(ovmfvartool.FLASH_GEOMETRIES)
+GEOMETRIES["4mib"] = ovmfvartool.FlashGeometry(4096, 1024, 0x1FE000, 0x200000)
+
+VENDORS = (
+    "gEfiGlobalVariableGuid",
+    "gEfiImageSecurityDatabaseGuid",
+    "gEfiMemoryTypeInformationGuid",
+    "gEdkiiVarErrorFlagGuid",
+)
+
+BENCHMARKS = ("parse", "dump", "export", "compile", "edit", "verify")
+
+
+def makeDocument(count, nameLength, dataSize, seed=0):
+    r = random.Random(seed)
+    doc = dict(Variables={})
+    for i in range(count):
+        vendorID = VENDORS[i % len(VENDORS)]
+        name = ("Var%d" % i).ljust(nameLength, "x")
+        doc["Variables"].setdefault(vendorID, {})[name] = {
+            "Data": bytes(r.getrandbits(8) for _ in range(dataSize)),
+            "Boot Access": True,
+            "Runtime Access": True,
+        }
+    return doc
+
+
+def makeStore(doc, deletedRatio, geometry):
+    # Compiles doc, then rewrites that fraction of its variables in place so
+    # that the store also holds deleted records, as a long-lived store does.
+    image = ovmfvartool.compileDocument(doc, geometry=geometry)
+    vs = ovmfvartool.VariableStore(image)
+    try:
+        docVars = doc["Variables"]
+        allVars = [(v, name) for v in docVars for name in docVars[v]]
+        for vendorID, name in allVars[: int(deletedRatio * len(allVars))]:
+            b = ovmfvartool.compileVariable(vendorID, name, docVars[vendorID][name])
+            vs.setRecord(ovmfvartool.lookupUUID(vendorID), name, b)
+    finally:
+        vs.close()
+    return image
+
+
+def benchParse(ctx):
+    vs = ovmfvartool.VariableStore(ctx["image"])
+    try:
+        for av in vs.variables():
+            av.name, av.data
+    finally:
+        vs.close()
+
+
+def benchDump(ctx):
+    with open(os.devnull, "w") as out, contextlib.redirect_stdout(out):
+        ovmfvartool.cmdDump({"input-file": ctx["path"], "deleted": True})
+
+
+def benchExport(ctx):
+    with open(os.devnull, "w") as out, contextlib.redirect_stdout(out):
+        ovmfvartool.cmdExport({"input-file": [ctx["path"]], "format": "yaml"})
+
+
+def benchCompile(ctx):
+    doc = ovmfvartool.loadDocument(io.BytesIO(ctx["yaml"]), "yaml")
+    ovmfvartool.compileDocument(doc, geometry=ctx["geometry"])
+
+
+def benchEdit(ctx):
+    # Updates up to 100 variables in place in a copy of the store, as set
+    # does, reclaiming if the store fills up.
+    image = bytearray(ctx["image"])
+    vs = ovmfvartool.VariableStore(image)
+    try:
+        for vendorID, name, x in ctx["edits"]:
+            b = ovmfvartool.compileVariable(vendorID, name, x)
+            vs.setRecord(ovmfvartool.lookupUUID(vendorID), name, b, reclaim=True)
+    finally:
+        vs.close()
+
+
+def benchVerify(ctx):
+    result = ovmfvartool.verifyImage(ctx["image"])
+    if not result["OK"]:
+        raise Exception("synthetic store failed to verify: %r" % result["Errors"])
+
+
+BENCHMARK_FUNCTIONS = dict(
+    parse=benchParse,
+    dump=benchDump,
+    export=benchExport,
+    compile=benchCompile,
+    edit=benchEdit,
+    verify=benchVerify,
+)
+
+
+def measure(fn, ctx, repeat):
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn(ctx)
+        times.append(time.perf_counter() - t)
+
+    # Peak memory is taken from a separate run, as tracing slows it down.
+    tracemalloc.start()
+    try:
+        fn(ctx)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return times, peak
+
+
+def runStore(params, benchmarks, repeat):
+    geometry = GEOMETRIES[params["geometry"]]
+    doc = makeDocument(params["count"], params["name_length"], params["data_size"])
+    image = makeStore(doc, params["deleted_ratio"], geometry)
+
+    edits = []
+    for vendorID, vendorVars in doc["Variables"].items():
+        for name, x in vendorVars.items():
+            edits.append((vendorID, name, dict(x, Data=x["Data"][::-1])))
+    edits = edits[:100]
+
+    vs = ovmfvartool.VariableStore(image)
+    try:
+        records = sum(1 for _ in vs.variables())
+        used = vs.usedLimit - vs.varOffset
+    finally:
+        vs.close()
+
+    results = []
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "OVMF_VARS.fd")
+        with open(path, "wb") as f:
+            f.write(image)
+
+        yamlOut = io.BytesIO()
+        ovmfvartool.dumpDocument(doc, yamlOut, "yaml")
+        ctx = dict(
+            image=bytes(image),
+            path=path,
+            yaml=yamlOut.getvalue(),
+            geometry=geometry,
+            edits=edits,
+        )
+
+        for name in benchmarks:
+            times, peak = measure(BENCHMARK_FUNCTIONS[name], ctx, repeat)
+            best = min(times)
+            n = len(edits) if name == "edit" else records
+            results.append(
+                dict(
+                    store=dict(params, records=records, used_bytes=used),
+                    benchmark=name,
+                    repeat=repeat,
+                    seconds_best=best,
+                    seconds_median=statistics.median(times),
+                    records_per_second=n / best if best else None,
+                    bytes_per_second=used / best if best and name != "edit" else None,
+                    peak_memory_bytes=peak,
+                )
+            )
+            print(
+                "%-8s %-7s %6d vars %5.0f%% deleted  %9.3f ms  %8d KiB peak"
+                % (
+                    params["geometry"],
+                    name,
+                    params["count"],
+                    params["deleted_ratio"] * 100,
+                    best * 1000,
+                    peak // 1024,
+                ),
+                file=sys.stderr,
+            )
+    return results
+
+
+def resultKey(r):
+    s = r["store"]
+    return (
+        r["benchmark"],
+        s["geometry"],
+        s["count"],
+        s["name_length"],
+        s["data_size"],
+        s["deleted_ratio"],
+    )
+
+
+def compareResults(old, new, threshold):
+    # Reports benchmarks which got slower by more than threshold (a fraction)
+    # and returns whether there were any.
+    oldByKey = {resultKey(r): r for r in old["results"]}
+    regressed = False
+    for r in new["results"]:
+        o = oldByKey.get(resultKey(r))
+        if not o or not o["seconds_best"]:
+            continue
+        ratio = r["seconds_best"] / o["seconds_best"]
+        if ratio > 1 + threshold:
+            regressed = True
+            print(
+                "regression: %s %.2fx slower (%.3f ms -> %.3f ms)"
+                % (
+                    " ".join(str(k) for k in resultKey(r)),
+                    ratio,
+                    o["seconds_best"] * 1000,
+                    r["seconds_best"] * 1000,
+                ),
+                file=sys.stderr,
+            )
+    return regressed
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument(
+        "--count", type=int, nargs="+", default=[100, 1000], help="variables"
+    )
+    ap.add_argument(
+        "--name-length",
+        type=int,
+        nargs="+",
+        default=[16],
+        help="variable name lengths in characters",
+    )
+    ap.add_argument(
+        "--data-size",
+        type=int,
+        nargs="+",
+        default=[64],
+        help="variable data sizes in bytes",
+    )
+    ap.add_argument(
+        "--deleted-ratio",
+        type=float,
+        nargs="+",
+        default=[0.0, 0.5],
+        help="fractions of variables which also have a deleted older record",
+    )
+    ap.add_argument(
+        "--geometry",
+        nargs="+",
+        choices=sorted(GEOMETRIES),
+        default=["4m"],
+        help="flash layouts (4m: 528 KiB, 2m: 128 KiB, 4mib: 4 MiB store)",
+    )
+    ap.add_argument(
+        "--benchmark",
+        nargs="+",
+        choices=BENCHMARKS,
+        default=list(BENCHMARKS),
+        help="benchmarks to run (default: all)",
+    )
+    ap.add_argument(
+        "--repeat", type=int, default=5, help="runs per benchmark (default: 5)"
+    )
+    ap.add_argument("--output", "-o", help="write the JSON report here")
+    ap.add_argument("--compare", help="earlier JSON report to compare against")
+    ap.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="slowdown (as a fraction) reported as a regression by --compare "
+        "(default: %(default)s)",
+    )
+    args = vars(ap.parse_args())
+
+    results = []
+    for geometry, count, nameLength, dataSize, deletedRatio in itertools.product(
+        args["geometry"],
+        args["count"],
+        args["name_length"],
+        args["data_size"],
+        args["deleted_ratio"],
+    ):
+        params = dict(
+            geometry=geometry,
+            count=count,
+            name_length=nameLength,
+            data_size=dataSize,
+            deleted_ratio=deletedRatio,
+        )
+        try:
+            results += runStore(params, args["benchmark"], args["repeat"])
+        except Exception as e:
+            print("skipping %r: %s" % (params, e), file=sys.stderr)
+
+    report = dict(
+        version=ovmfvartool.__version__,
+        python=platform.python_version(),
+        platform=platform.platform(),
+        timestamp=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        max_rss_kib=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        results=results,
+    )
+
+    if args.get("output"):
+        with open(args["output"], "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+    if args.get("compare"):
+        with open(args["compare"]) as f:
+            if compareResults(json.load(f), report, args["threshold"]):
+                return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
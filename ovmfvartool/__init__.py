@@ -1,6 +1,13 @@
-import sys, argparse, struct, uuid, binascii, io, datetime
+import sys, os, re, argparse, struct, uuid, binascii, io, datetime, mmap, tempfile
+import fnmatch, itertools, functools, hashlib, collections, json, base64, socket
+import fcntl, zlib, marshal, errno, stat
 import yaml
 
+try:
+    from yaml import CSafeLoader as YAMLLoader, CSafeDumper as YAMLDumper
+except ImportError:
+    from yaml import SafeLoader as YAMLLoader, SafeDumper as YAMLDumper
+
 
 __version__ = "0.0.0"
 
@@ -10,13 +17,33 @@ def nicehex(x, L):
     return s.rjust(L, " ")
 
 
-def repasc(x):
-    if x >= 0x20 and x <= 0x7E:
-        return chr(x)
-    return "."
+HEXDUMP_ASCII = bytes(x if 0x20 <= x <= 0x7E else 0x2E for x in range(256))
+HEXDUMP_ELIDED = (
+    "*                               **                                             \n"
+)
+HEXDUMP_CHUNK_SIZE = 64 * 1024
+
+
+def hexdumpHex(d):
+    # Formats up to 16 bytes as two groups of eight, padding short lines to
+    # the full width.
+    if len(d) == 16:
+        h = d.hex(" ")
+        return h[:23] + "  " + h[24:]
+    dh = d.hex().ljust(32, " ")
+    return (
+        " ".join(dh[i : i + 2] for i in range(0, 16, 2))
+        + "  "
+        + " ".join(dh[i : i + 2] for i in range(16, 32, 2))
+    )
 
 
-def hexdump(f, offset=0, limit=None, elide=False, lba=False, reverse=False):
+def hexdump(
+    f, offset=0, limit=None, elide=False, lba=False, reverse=False, out=None
+):
+    # Reads f a chunk at a time, converting each chunk to hex and ASCII in one
+    # go and writing its lines to out (by default sys.stdout) in one call.
+    out = out or sys.stdout
     if limit is None:
         prev = f.tell()
         f.seek(0, 2)
@@ -26,108 +53,217 @@ def hexdump(f, offset=0, limit=None, elide=False, lba=False, reverse=False):
         fl = limit
 
     offsetChars = len(hex(fl + offset)[2:])
+    if lba is True:
+        lba = (4096, 4608)
     consumed = 0
 
     prevLine = None
     eliding = False
     while limit is None or consumed < limit:
-        Lr = 16
-        if limit is not None and consumed + Lr > limit:
-            Lr = limit - consumed
+        n = HEXDUMP_CHUNK_SIZE
+        if limit is not None and consumed + n > limit:
+            n = limit - consumed
 
-        d = f.read(Lr)
-        if d == b"":
+        chunk = f.read(n)
+        if chunk == b"":
             break
 
-        if elide and d == prevLine:
-            if not eliding:
-                eliding = True
-                print(
-                    "*                               **                                             "
-                )
-        else:
-            eliding = False
-            dh = binascii.hexlify(d).decode("ascii")
-            if len(d) < 16:
-                dh = dh.ljust(32, " ")
-
-            asc = ""
-            for x in d:
-                asc += repasc(x)
-
-            offs = "%08x" % offset
-
-            asc = "|" + asc + "|"
-            pre = ""
-            if lba:
-                if lba is True:
-                    lba = (4096, 4608)
-                blkDataSize, blkSize = lba
-                om = offset % blkSize
-                oms = "D"
-                if om >= blkDataSize:
-                    oms = "H"
-                    om -= blkDataSize
-                pre = "%s %s%s> " % (
-                    nicehex(offset // blkSize, offsetChars),
-                    oms,
-                    nicehex(om, 4),
-                )
-            print(
-                "%s%s)  %s %s %s %s %s %s %s %s  %s %s %s %s %s %s %s %s  %s"
-                % (
-                    pre,
-                    nicehex(offset, offsetChars),
-                    dh[0:2],
-                    dh[2:4],
-                    dh[4:6],
-                    dh[6:8],
-                    dh[8:10],
-                    dh[10:12],
-                    dh[12:14],
-                    dh[14:16],
-                    dh[16:18],
-                    dh[18:20],
-                    dh[20:22],
-                    dh[22:24],
-                    dh[24:26],
-                    dh[26:28],
-                    dh[28:30],
-                    dh[30:32],
-                    asc.ljust(18, " "),
+        hx = chunk.hex(" ")
+        asc = chunk.translate(HEXDUMP_ASCII).decode("ascii")
+        lines = []
+        for i in range(0, len(chunk), 16):
+            d = chunk[i : i + 16]
+            if elide and d == prevLine:
+                if not eliding:
+                    eliding = True
+                    lines.append(HEXDUMP_ELIDED)
+            else:
+                eliding = False
+                if len(d) == 16:
+                    j = i * 3
+                    h = hx[j : j + 23] + "  " + hx[j + 24 : j + 47]
+                else:
+                    h = hexdumpHex(d)
+
+                pre = ""
+                if lba:
+                    blkDataSize, blkSize = lba
+                    om = offset % blkSize
+                    oms = "D"
+                    if om >= blkDataSize:
+                        oms = "H"
+                        om -= blkDataSize
+                    pre = "%s %s%s> " % (
+                        nicehex(offset // blkSize, offsetChars),
+                        oms,
+                        nicehex(om, 4),
+                    )
+                lines.append(
+                    "%s%*x)  %s  %s\n"
+                    % (
+                        pre,
+                        offsetChars,
+                        offset,
+                        h,
+                        ("|" + asc[i : i + len(d)] + "|").ljust(18, " "),
+                    )
                 )
-            )
 
-        offset += Lr
-        consumed += Lr
-        prevLine = d
+            offset += len(d)
+            prevLine = d
+
+        consumed += len(chunk)
+        out.write("".join(lines))
 
     return consumed
 
 
-knownUUIDs = []
+knownUUIDs = {}
 knownUUIDsByName = {}
 
+# External GUID databases, given by addGuidDatabase() or the
+# OVMFVARTOOL_GUID_DB environment variable (a list of paths), are only loaded
+# by the first lookup which the built-in names don't answer. Their entries
+# are kept keyed by the 16 UUID bytes rather than as UUID objects, so that
+# loading a large database from its cached form costs little more than
+# reading it, and the index by name is only built if a name is looked up.
+guidDatabasePaths = []
+guidDatabaseNames = None
+guidDatabaseUUIDs = None
+GUID_DATABASE_CACHE_VERSION = 2
+
+GUID_TEXT_RE = re.compile(
+    r"\b([0-9A-Fa-f]{8}-[0-9A-Fa-f]{4}-[0-9A-Fa-f]{4}-[0-9A-Fa-f]{4}-[0-9A-Fa-f]{12})\b"
+)
+GUID_DEC_RE = re.compile(
+    r"^\s*([A-Za-z_]\w*)\s*=\s*\{\s*(0x[0-9A-Fa-f]+)\s*,\s*(0x[0-9A-Fa-f]+)\s*,"
+    r"\s*(0x[0-9A-Fa-f]+)\s*,\s*\{([^}]*)\}\s*\}"
+)
+GUID_NAME_RE = re.compile(r"[A-Za-z_]\w*")
+
 
 def registerUUID(s, name):
     u = uuid.UUID(s)
-    knownUUIDs.append((u, name))
+    knownUUIDs.setdefault(u, name)
     knownUUIDsByName[name] = u
     return u
 
 
 def resolveUUID(u):
-    for (u2, u2Name) in knownUUIDs:
-        if u2 == u:
-            return u2Name
-    return str(u)
+    name = knownUUIDs.get(u)
+    if name is None:
+        name = loadGuidDatabases().get(u.bytes)
+    return name or str(u)
 
 
 def lookupUUID(u):
+    global guidDatabaseUUIDs
     if u in knownUUIDsByName:
         return knownUUIDsByName[u]
-    else:
-        return uuid.UUID(u)
+    if guidDatabaseUUIDs is None:
+        # Where a name is used more than once, the first GUID wins.
+        names = loadGuidDatabases()
+        guidDatabaseUUIDs = {v: k for k, v in reversed(names.items())}
+    b = guidDatabaseUUIDs.get(u)
+    if b is not None:
+        return uuid.UUID(bytes=b)
+    return uuid.UUID(u)
+
+
+def addGuidDatabase(path):
+    global guidDatabaseNames, guidDatabaseUUIDs
+    guidDatabasePaths.append(path)
+    guidDatabaseNames = guidDatabaseUUIDs = None
+
+
+def setGuidDatabases(paths):
+    # Replaces the databases given by addGuidDatabase(). Worker processes are
+    # given the parent's with this, since they don't inherit module state
+    # under the spawn and forkserver start methods.
+    global guidDatabaseNames, guidDatabaseUUIDs
+    if paths != guidDatabasePaths:
+        guidDatabasePaths[:] = paths
+        guidDatabaseNames = guidDatabaseUUIDs = None
+
+
+def parseGuidDatabase(f):
+    # Reads GUID names from EDK2 .dec/.h style definitions
+    # (gFooGuid = { 0x..., 0x..., 0x..., { 0x..., ... } }) or from lines with
+    # a GUID in the usual text form and a name, in either order and separated
+    # by whitespace or commas. GUIDs are converted to the byte order used by
+    # the registry. Returns {bytes: name}.
+    names = {}
+    for line in f:
+        line = line.split("#", 1)[0]
+        m = GUID_DEC_RE.match(line)
+        if m:
+            name = m.group(1)
+            data4 = [int(x, 0) for x in m.group(5).split(",")]
+            if len(data4) != 8:
+                continue
+            b = struct.pack(
+                "<IHH8B",
+                int(m.group(2), 16),
+                int(m.group(3), 16),
+                int(m.group(4), 16),
+                *data4
+            )
+        else:
+            m = GUID_TEXT_RE.search(line)
+            if not m:
+                continue
+            n = GUID_NAME_RE.search(line[: m.start()] + " " + line[m.end() :])
+            if not n:
+                continue
+            name = n.group(0)
+            b = uuid.UUID(m.group(1)).bytes_le
+        names.setdefault(b, name)
+    return names
+
+
+def loadGuidDatabase(path):
+    # Parsed databases are cached in marshal form, keyed by the path,
+    # modification time and size of the database.
+    st = os.stat(path)
+    key = "%s\0%d\0%d" % (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+    cachePath = os.path.join(
+        cacheDirectory(),
+        "guids-%s.marshal" % hashlib.sha256(key.encode()).hexdigest()[:16],
+    )
+    try:
+        with open(cachePath, "rb") as f:
+            version, names = marshal.loads(f.read())
+        if version == GUID_DATABASE_CACHE_VERSION:
+            return names
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        names = parseGuidDatabase(f)
+    try:
+        os.makedirs(os.path.dirname(cachePath), exist_ok=True)
+        writeFileAtomically(
+            cachePath, marshal.dumps((GUID_DATABASE_CACHE_VERSION, names))
+        )
+    except OSError:
+        pass
+    return names
+
+
+def loadGuidDatabases():
+    global guidDatabaseNames, guidDatabaseUUIDs
+    if guidDatabaseNames is None:
+        paths = list(guidDatabasePaths)
+        if os.environ.get("OVMFVARTOOL_GUID_DB"):
+            paths += os.environ["OVMFVARTOOL_GUID_DB"].split(os.pathsep)
+
+        # Earlier databases take precedence.
+        names = {}
+        for path in reversed(paths):
+            names.update(loadGuidDatabase(path))
+        guidDatabaseNames = names
+        guidDatabaseUUIDs = None
+    return guidDatabaseNames
 
 
 gEfiSystemNvDataFvGuid = registerUUID(
@@ -157,7 +293,7 @@ gEfiImageSecurityDatabaseGuid = registerUUID(
     "cbb219d7-3a3d-9645-a3bc-dad00e67656f", "gEfiImageSecurityDatabaseGuid"
 )
 gEfiSecureBootEnableDisableGuid = registerUUID(
-    "f0a30bc7-af08-4556-99c4-001009c93a44", "gEfiSecureBootEnableDisableGuid"
+    "c70ba3f0-08af-5645-99c4-001009c93a44", "gEfiSecureBootEnableDisableGuid"
 )
 gEfiCustomModeEnableGuid = registerUUID(
     "0cec76c0-2870-9943-a072-71ee5c448b9f", "gEfiCustomModeEnableGuid"
@@ -175,11 +311,92 @@ gEfiVendorKeysNvGuid = registerUUID(
 mBmHardDriveBootVariableGuid = registerUUID(
     "e1e9b7fa-dd39-2b4f-8408-e20e906cb6de", "mBmHardDriveBootVariableGuid"
 )
+gEfiCertSha1Guid = registerUUID(
+    "12a56c82-10cf-c94a-b187-be01496631bd", "gEfiCertSha1Guid"
+)
+gEfiCertSha256Guid = registerUUID(
+    "2616c4c1-4c50-9240-aca9-41f936934328", "gEfiCertSha256Guid"
+)
+gEfiCertSha384Guid = registerUUID(
+    "07533eff-d09f-c948-85f1-8ad56c701e01", "gEfiCertSha384Guid"
+)
+gEfiCertSha512Guid = registerUUID(
+    "ae0f3e09-c4a6-504f-9f1b-d41e2b89c19a", "gEfiCertSha512Guid"
+)
+gEfiCertRsa2048Guid = registerUUID(
+    "e866573c-9c26-344e-aa14-ed776e85b3b6", "gEfiCertRsa2048Guid"
+)
+gEfiCertX509Guid = registerUUID(
+    "a159c0a5-e494-a74a-87b5-ab155c2bf072", "gEfiCertX509Guid"
+)
+gEfiCertX509Sha256Guid = registerUUID(
+    "92a4d23b-c096-7940-b420-fcf98ef103ed", "gEfiCertX509Sha256Guid"
+)
+gEfiCertX509Sha384Guid = registerUUID(
+    "6e877670-c280-e64e-aad2-28b349a6865b", "gEfiCertX509Sha384Guid"
+)
+gEfiCertX509Sha512Guid = registerUUID(
+    "63bf6d44-0225-da4c-bcfa-2465d2b0fe9d", "gEfiCertX509Sha512Guid"
+)
+gEfiCertPkcs7Guid = registerUUID(
+    "9dd2af4a-df68-ee49-8aa9-347d375665a7", "gEfiCertPkcs7Guid"
+)
+gEdkiiWorkingBlockSignatureGuid = registerUUID(
+    "2b29589e-687c-7d49-a0ce-6500fd9f1b95", "gEdkiiWorkingBlockSignatureGuid"
+)
 
 FV_MAGIC = 0x4856465F
 
+FV_HEADER_STRUCT = struct.Struct("<16s16sQIIHHHBB")
+FV_BLOCK_MAP_ENTRY_STRUCT = struct.Struct("<II")
+VARIABLE_STORE_HEADER_STRUCT = struct.Struct("<16sIBBHI")
+AUTHENTICATED_VARIABLE_HEADER_STRUCT = struct.Struct("<HBBIQ16sIII16s")
+
+FTW_WORKING_BLOCK_HEADER_STRUCT = struct.Struct("<16sIB3sQ")
+FTW_WRITE_HEADER_STRUCT = struct.Struct("<B3x16s4xQQ")
+FTW_WRITE_RECORD_STRUCT = struct.Struct("<B7xQQQq")
+
+# Bits of the state bytes of FTW write headers and records. As with the
+# variable states, a bit is set by clearing it.
+FTW_HEADER_ALLOCATED = 0x01
+FTW_WRITES_ALLOCATED = 0x02
+FTW_WRITE_COMPLETE = 0x04
+FTW_SPARE_COMPLETE = 0x02
+FTW_DESTINATION_COMPLETE = 0x04
+
+# Bits of the state byte of the FTW working block header.
+FTW_WORKING_BLOCK_VALID = 0x01
+FTW_WORKING_BLOCK_INVALID = 0x02
+
+# Bits of the state byte of a variable record, which are cleared in turn as
+# the record is written, added and deleted. The VAR_* states below are the
+# values EDK2 ANDs into the state byte to clear each of them.
+VAR_STATE_HEADER_VALID = 0x80
+VAR_STATE_ADDED = 0x40
+VAR_STATE_DELETED = 0x02
+VAR_STATE_IN_DELETED_TRANSITION = 0x01
+
+VAR_IN_DELETED_TRANSITION = 0xFE
+VAR_DELETED = 0xFD
+VAR_HEADER_VALID_ONLY = 0x7F
+VAR_ADDED = 0x3F
+
 
 class UEFITime(object):
+    __slots__ = (
+        "year",
+        "month",
+        "day",
+        "hour",
+        "minute",
+        "second",
+        "pad1",
+        "nanosecond",
+        "timezone",
+        "daylight",
+        "pad2",
+    )
+
     def __init__(self, t=None):
         if t:
             (
@@ -207,7 +424,6 @@ class UEFITime(object):
                 0,
                 0,
             )
-            print(t)
         else:
             (
                 self.year,
@@ -277,9 +493,154 @@ class UEFITime(object):
         )
 
 
+def ftwHeaderCrc(b):
+    # The CRC covers the whole header with the CRC and state fields erased.
+    b = bytearray(b[: FTW_WORKING_BLOCK_HEADER_STRUCT.size])
+    b[16:20] = b"\xFF\xFF\xFF\xFF"
+    b[20] = 0xFF
+    return zlib.crc32(b)
+
+
+def ftwWorkingBlockHeader(size):
+    b = bytearray(
+        FTW_WORKING_BLOCK_HEADER_STRUCT.pack(
+            gEdkiiWorkingBlockSignatureGuid.bytes,
+            0xFFFFFFFF,
+            0xFF,
+            b"\xFF\xFF\xFF",
+            size - FTW_WORKING_BLOCK_HEADER_STRUCT.size,
+        )
+    )
+    b[16:20] = struct.pack("<I", ftwHeaderCrc(b))
+    b[20] = 0xFE
+    return bytes(b)
+
+
+def ftwWorkingBlockValid(buf, offset):
+    sig, crc, state, _, _ = FTW_WORKING_BLOCK_HEADER_STRUCT.unpack_from(buf, offset)
+    return (
+        sig == gEdkiiWorkingBlockSignatureGuid.bytes
+        and crc == ftwHeaderCrc(buf[offset : offset + 32])
+        and state & (FTW_WORKING_BLOCK_VALID | FTW_WORKING_BLOCK_INVALID)
+        == FTW_WORKING_BLOCK_INVALID
+    )
+
+
+def ftwLastWrite(buf, offset, end):
+    # Walks the write queue following the working block header at offset and
+    # returns the last write header as (offset, state, records), where each
+    # record is (offset, state, lba, offset in block, length), or None if the
+    # queue is empty.
+    last = None
+    pos = offset + FTW_WORKING_BLOCK_HEADER_STRUCT.size
+    while pos + FTW_WRITE_HEADER_STRUCT.size <= end:
+        state, _, numWrites, privSize = FTW_WRITE_HEADER_STRUCT.unpack_from(buf, pos)
+        if state & FTW_HEADER_ALLOCATED:
+            break
+        recSize = FTW_WRITE_RECORD_STRUCT.size + privSize
+        recOffset = pos + FTW_WRITE_HEADER_STRUCT.size
+        if state & FTW_WRITES_ALLOCATED:
+            numWrites = 0
+        if recOffset + numWrites * recSize > end:
+            raise Exception("fault tolerant write queue is corrupt at 0x%x" % pos)
+
+        records = []
+        for i in range(numWrites):
+            o = recOffset + i * recSize
+            rs, lba, off, length, _ = FTW_WRITE_RECORD_STRUCT.unpack_from(buf, o)
+            records.append((o, rs, lba, off, length))
+        last = (pos, state, records)
+        pos = recOffset + numWrites * recSize
+    return last
+
+
+class FlashGeometry(object):
+    # Layout of a variable flash volume as built by OVMF: the variable store
+    # (starting with the FV header) takes up the first liveSize bytes and is
+    # followed by a 4 KiB event log, the fault-tolerant write working block
+    # and then the spare area, which takes up the last spareSize bytes.
+    def __init__(self, blockSize, numBlocks, liveSize, spareSize, ftwOffset=None):
+        self.blockSize = blockSize
+        self.numBlocks = numBlocks
+        self.liveSize = liveSize
+        self.spareSize = spareSize
+        self.ftwOffset = liveSize + 0x1000 if ftwOffset is None else ftwOffset
+
+    @property
+    def fvLen(self):
+        return self.blockSize * self.numBlocks
+
+    @property
+    def spareOffset(self):
+        return self.fvLen - self.spareSize
+
+    @property
+    def ftwSize(self):
+        return self.spareOffset - self.ftwOffset
+
+    @classmethod
+    def fromStore(cls, vs):
+        blkLen = vs.fvh.blkInfo[0][1]
+        numBlk = sum(n * L for n, L in vs.fvh.blkInfo) // blkLen
+        liveSize = vs.fvh.hdrLen + vs.vsh.len
+        fvLen = numBlk * blkLen
+
+        # The working block normally follows the event log, but look for its
+        # signature in case the layout is different.
+        sig = gEdkiiWorkingBlockSignatureGuid.bytes
+        ftwOffset = liveSize + 0x1000
+        start = vs.offset + ftwOffset
+        if vs.buf[start : start + len(sig)] != sig:
+            ftwOffset = bytes(vs.buf[vs.offset : vs.offset + fvLen]).find(sig, liveSize)
+        if ftwOffset < 0:
+            ftwOffset = liveSize + 0x1000
+            spareSize = fvLen - ftwOffset - 0x1000
+        else:
+            (writeQueueSize,) = struct.unpack_from(
+                "<Q", vs.buf, vs.offset + ftwOffset + 24
+            )
+            spareSize = fvLen - ftwOffset - writeQueueSize - 32
+
+        return cls(blkLen, numBlk, liveSize, spareSize, ftwOffset)
+
+    @classmethod
+    def fromImage(cls, buf):
+        vs = VariableStore(buf)
+        try:
+            return cls.fromStore(vs)
+        finally:
+            vs.close()
+
+    @classmethod
+    def fromArgument(cls, s):
+        if s in FLASH_GEOMETRIES:
+            return FLASH_GEOMETRIES[s]
+        with open(s, "rb") as f:
+            return cls.fromImage(f.read())
+
+
+FLASH_GEOMETRIES = {
+    # OVMF_VARS_4M.fd; this is the default.
+    "4m": FlashGeometry(4096, 132, 0x40000, 0x42000),
+    # OVMF_VARS.fd from the 1 MiB and 2 MiB builds.
+    "2m": FlashGeometry(4096, 32, 0xE000, 0x10000),
+}
+
+
 class FirmwareVolumeHeader(object):
     @classmethod
     def deserialize(cls, f):
+        b = f.read(FV_HEADER_STRUCT.size)
+        while True:
+            e = f.read(FV_BLOCK_MAP_ENTRY_STRUCT.size)
+            b += e
+            if len(e) < FV_BLOCK_MAP_ENTRY_STRUCT.size or e == b"\0" * len(e):
+                break
+
+        return cls.deserializeFrom(b)
+
+    @classmethod
+    def deserializeFrom(cls, buf, offset=0):
         o = cls()
         (
             o.vector,
@@ -292,7 +653,7 @@ class FirmwareVolumeHeader(object):
             o.extHdrOff,
             o.reserved,
             o.rev,
-        ) = struct.unpack("<16s16sQIIHHHBB", f.read(56))
+        ) = FV_HEADER_STRUCT.unpack_from(buf, offset)
         o.fsUUID = uuid.UUID(bytes=o.fsUUID)
 
         if o.magic != FV_MAGIC:
@@ -300,12 +661,14 @@ class FirmwareVolumeHeader(object):
 
         if o.fsUUID != gEfiSystemNvDataFvGuid:
             raise Exception(
-                "unexpected UUID, not a EFI_FIRMWARE_VOLUME_HEADER: %s" % fsUUID
+                "unexpected UUID, not a EFI_FIRMWARE_VOLUME_HEADER: %s" % o.fsUUID
             )
 
         o.blkInfo = []
+        offset += FV_HEADER_STRUCT.size
         while True:
-            numBlk, blkLen = struct.unpack("<II", f.read(8))
+            numBlk, blkLen = FV_BLOCK_MAP_ENTRY_STRUCT.unpack_from(buf, offset)
+            offset += FV_BLOCK_MAP_ENTRY_STRUCT.size
             if numBlk == 0 and blkLen == 0:
                 break
             o.blkInfo.append((numBlk, blkLen))
@@ -333,21 +696,31 @@ class FirmwareVolumeHeader(object):
         return b
 
     @classmethod
-    def create(cls):
+    def create(cls, geometry=None):
+        geometry = geometry or FLASH_GEOMETRIES["4m"]
         o = cls()
         o.vector = b"\x00" * 16
         o.fsUUID = gEfiSystemNvDataFvGuid
-        o.fvLen = 528 * 1024
+        o.fvLen = geometry.fvLen
         o.magic = FV_MAGIC
         o.flags = 0x4FEFF
-        o.hdrLen = 72
-        o.checksum = 0xB8AF
+        o.blkInfo = [(geometry.numBlocks, geometry.blockSize)]
+        o.hdrLen = FV_HEADER_STRUCT.size + FV_BLOCK_MAP_ENTRY_STRUCT.size * (
+            len(o.blkInfo) + 1
+        )
+        o.checksum = 0
         o.extHdrOff = 0
         o.reserved = 0
         o.rev = 2
-        o.blkInfo = [(132, 4096)]
+        o.checksum = o.computeChecksum()
         return o
 
+    def computeChecksum(self):
+        # The 16-bit words of the header, including the checksum, sum to zero.
+        b = self.serialize()
+        words = struct.unpack("<%dH" % (len(b) // 2), b)
+        return (self.checksum - sum(words)) & 0xFFFF
+
     def print(self):
         print("Firmware Volume Header")
         print("======================")
@@ -375,21 +748,30 @@ class FirmwareVolumeHeader(object):
 class VariableStoreHeader(object):
     @classmethod
     def deserialize(cls, f):
+        return cls.deserializeFrom(f.read(VARIABLE_STORE_HEADER_STRUCT.size))
+
+    @classmethod
+    def deserializeFrom(cls, buf, offset=0, strict=True):
         o = cls()
 
-        o.hdrUUID, o.len, o.fmt, o.state, o.reserved1, o.reserved2 = struct.unpack(
-            "<16sIBBHI", f.read(28)
-        )
+        (
+            o.hdrUUID,
+            o.len,
+            o.fmt,
+            o.state,
+            o.reserved1,
+            o.reserved2,
+        ) = VARIABLE_STORE_HEADER_STRUCT.unpack_from(buf, offset)
         o.hdrUUID = uuid.UUID(bytes=o.hdrUUID)
 
         if o.hdrUUID != gEfiAuthenticatedVariableGuid:
             raise Exception("unexpected UUID, not a VARIABLE_STORE_HEADER")
 
-        if o.fmt != 0x5A:
+        if o.fmt != 0x5A and strict:
             raise Exception(
                 "VARIABLE_STORE_HEADER format is not set to FORMATTED (0x5A)"
             )
-        if o.state != 0xFE:
+        if o.state != 0xFE and strict:
             raise Exception("VARIABLE_STORE_HEADER state is not set to HEALTHY (0xFE)")
 
         return o
@@ -406,10 +788,12 @@ class VariableStoreHeader(object):
         )
 
     @classmethod
-    def create(cls):
+    def create(cls, geometry=None, fvh=None):
+        geometry = geometry or FLASH_GEOMETRIES["4m"]
+        fvh = fvh or FirmwareVolumeHeader.create(geometry)
         o = cls()
         o.hdrUUID = gEfiAuthenticatedVariableGuid
-        o.len = 262072
+        o.len = geometry.liveSize - fvh.hdrLen
         o.fmt = 0x5A
         o.state = 0xFE
         o.reserved1 = 0
@@ -426,35 +810,92 @@ class VariableStoreHeader(object):
         print("")
 
 
+def isLiveState(state):
+    # A record is live from when it is marked VAR_ADDED until it is marked
+    # VAR_DELETED. One also in deleted transition is only live if the update
+    # which was replacing it didn't complete (see VariableStore.iterVariables).
+    state ^= 0xFF
+    return bool(state & VAR_STATE_ADDED) and not state & VAR_STATE_DELETED
+
+
+class LazyHeaderField(object):
+    # An AuthenticatedVariable field which is only unpacked from the raw
+    # record header (and decoded, if decode is given) when first accessed.
+    def __init__(self, slot, fmt, offset, decode=None):
+        self.slot = slot
+        self.fmt = fmt
+        self.offset = offset
+        self.decode = decode
+
+    def __get__(self, o, cls):
+        if o is None:
+            return self
+        v = getattr(o, self.slot)
+        if v is None and o._buf is not None:
+            (v,) = struct.unpack_from(self.fmt, o._buf, o.offset + self.offset)
+            if self.decode:
+                v = self.decode(v)
+            setattr(o, self.slot, v)
+        return v
+
+    def __set__(self, o, v):
+        setattr(o, self.slot, v)
+
+
 class AuthenticatedVariable(object):
+    # Records parsed from a buffer only unpack what is needed to walk the
+    # store; the other fields, name and data are decoded from the buffer on
+    # first access.
+    __slots__ = (
+        "offset",
+        "magic",
+        "state",
+        "nameLen",
+        "dataLen",
+        "_buf",
+        "_reserved1",
+        "_flags",
+        "_monotonicCount",
+        "_timestamp",
+        "_pubKeyIdx",
+        "_vendorUUID",
+        "_name",
+        "_data",
+    )
+
+    reserved1 = LazyHeaderField("_reserved1", "<B", 3)
+    flags = LazyHeaderField("_flags", "<I", 4)
+    monotonicCount = LazyHeaderField("_monotonicCount", "<Q", 8)
+    timestamp = LazyHeaderField("_timestamp", "<16s", 16, UEFITime.deserialize)
+    pubKeyIdx = LazyHeaderField("_pubKeyIdx", "<I", 32)
+    vendorUUID = LazyHeaderField(
+        "_vendorUUID", "<16s", 44, lambda b: uuid.UUID(bytes=b)
+    )
+
+    def __init__(self):
+        self.offset = None
+        self._buf = None
+        self._reserved1 = None
+        self._flags = None
+        self._monotonicCount = None
+        self._timestamp = None
+        self._pubKeyIdx = None
+        self._vendorUUID = None
+        self._name = None
+        self._data = None
+
     @classmethod
     def deserialize(cls, f):
-        o = cls()
+        b = f.read(AUTHENTICATED_VARIABLE_HEADER_STRUCT.size)
+        magic, _, _, _, _, _, _, nameLen, dataLen, _ = (
+            AUTHENTICATED_VARIABLE_HEADER_STRUCT.unpack(b)
+        )
+        if magic == 0x55AA:
+            b += f.read(nameLen + dataLen)
 
-        (
-            o.magic,
-            o.state,
-            o.reserved1,
-            o.flags,
-            o.monotonicCount,
-            o.timestamp,
-            o.pubKeyIdx,
-            o.nameLen,
-            o.dataLen,
-            o.vendorUUID,
-        ) = struct.unpack("<HBBIQ16sIII16s", f.read(60))
-        o.vendorUUID = uuid.UUID(bytes=o.vendorUUID)
-        o.timestamp = UEFITime.deserialize(o.timestamp)
-
-        if o.magic == 0xFFFF:
+        o = cls.deserializeFrom(b)
+        if not o:
             return None
-        if o.magic != 0x55AA:
-            raise Exception(
-                "unexpected magic (0x%x), not an AUTHENTICATED_VARIABLE_HEADER" % magic
-            )
-
-        o.name = f.read(o.nameLen).decode("utf-16le").rstrip("\0")
-        o.data = f.read(o.dataLen)
 
         if f.tell() % 4:
             f.read(4 - (f.tell() % 4))
@@ -462,6 +903,76 @@ class AuthenticatedVariable(object):
         assert (f.tell() % 4) == 0
         return o
 
+    @classmethod
+    def deserializeFrom(cls, buf, offset=0):
+        # The record keeps a reference to buf, which should not be modified
+        # other than through VariableStore while the record is in use.
+        magic, state = struct.unpack_from("<HB", buf, offset)
+        if magic == 0xFFFF:
+            return None
+        if magic != 0x55AA:
+            raise Exception(
+                "unexpected magic (0x%x), not an AUTHENTICATED_VARIABLE_HEADER" % magic
+            )
+
+        o = cls()
+        o.magic = magic
+        o.state = state
+        o.nameLen, o.dataLen = struct.unpack_from("<II", buf, offset + 36)
+        o.offset = offset
+        o._buf = buf
+        end = offset + AUTHENTICATED_VARIABLE_HEADER_STRUCT.size
+        if end + o.nameLen + o.dataLen > len(buf):
+            raise Exception("variable at 0x%x extends past end of store" % offset)
+        return o
+
+    def detach(self):
+        # Decodes all fields, so that the record no longer refers to the
+        # buffer it was parsed from.
+        for k in (
+            "reserved1",
+            "flags",
+            "monotonicCount",
+            "timestamp",
+            "pubKeyIdx",
+            "vendorUUID",
+            "name",
+            "data",
+        ):
+            getattr(self, k)
+        self._buf = None
+        return self
+
+    @property
+    def name(self):
+        if self._name is None and self._buf is not None:
+            start = self.offset + AUTHENTICATED_VARIABLE_HEADER_STRUCT.size
+            b = self._buf[start : start + self.nameLen]
+            self._name = str(b, "utf-16le").rstrip("\0")
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        self._name = name
+
+    @property
+    def data(self):
+        if self._data is None and self._buf is not None:
+            start = self.offset + AUTHENTICATED_VARIABLE_HEADER_STRUCT.size
+            start += self.nameLen
+            self._data = bytes(self._buf[start : start + self.dataLen])
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+
+    @property
+    def size(self):
+        # Includes the padding which aligns the next record.
+        n = AUTHENTICATED_VARIABLE_HEADER_STRUCT.size + self.nameLen + self.dataLen
+        return (n + 3) & ~3
+
     @classmethod
     def deserializeFromDocument(cls, vendorID, name, doc):
         o = cls()
@@ -494,7 +1005,7 @@ class AuthenticatedVariable(object):
         o.data = doc["Data"]
         o.dataLen = len(o.data)
         o.nameLen = len(name) * 2 + 2
-        o.state = (0x40 | 0x80) ^ 0xFF
+        o.state = VAR_ADDED
         o.vendorUUID = lookupUUID(vendorID)
         return o
 
@@ -521,23 +1032,24 @@ class AuthenticatedVariable(object):
 
     @property
     def isDeleted(self):
-        state = self.state ^ 0xFF
-        return bool(state & 2)
+        # True of any record which isn't live: one deleted, or one whose
+        # update was interrupted before it was marked VAR_ADDED.
+        return not isLiveState(self.state)
+
+    @property
+    def inDeletedTransition(self):
+        return bool((self.state ^ 0xFF) & VAR_STATE_IN_DELETED_TRANSITION)
 
     def print(self):
         state = self.state ^ 0xFF
         origState = state
-        VAR_IN_DELETED_TRANSITION = 0xFE ^ 0xFF
-        VAR_DELETED = 0xFD ^ 0xFF
-        VAR_HEADER_VALID_ONLY = 0x7F ^ 0xFF
-        VAR_ADDED = 0x40
 
         stext = ""
         for n, v in (
-            ("VAR_IN_DELETED_TRANSITION", VAR_IN_DELETED_TRANSITION),
-            ("VAR_DELETED", VAR_DELETED),
-            ("VAR_HEADER_VALID_ONLY", VAR_HEADER_VALID_ONLY),
-            ("VAR_ADDED", VAR_ADDED),
+            ("VAR_IN_DELETED_TRANSITION", VAR_STATE_IN_DELETED_TRANSITION),
+            ("VAR_DELETED", VAR_STATE_DELETED),
+            ("VAR_HEADER_VALID_ONLY", VAR_STATE_HEADER_VALID),
+            ("VAR_ADDED", VAR_STATE_ADDED),
         ):
             if (state & v) == v:
                 if len(stext) > 0:
@@ -581,136 +1093,2443 @@ class AuthenticatedVariable(object):
         if t:
             print("Timestamp:           %s" % t)
         print("Data Length:         %s bytes" % self.dataLen)
+        if self.vendorUUID == gEfiGlobalVariableGuid and LOAD_OPTION_RE.match(
+            self.name
+        ):
+            try:
+                lo = decodeLoadOption(self.data)
+            except Exception as e:
+                print("Load Option:         cannot decode: %s" % e)
+            else:
+                print("Description:         %s" % lo.description)
+                print("Device Path:         %s" % lo.text)
+                print(
+                    "Load Attributes:     0x%x%s"
+                    % (lo.attributes, " (active)" if lo.isActive else "")
+                )
+        if self.vendorUUID == gEfiGlobalVariableGuid and LOAD_OPTION_ORDER_RE.match(
+            self.name
+        ):
+            prefix = self.name[: -len("Order")]
+            print(
+                "Order:               %s"
+                % ", ".join(
+                    "%s%04X" % (prefix, n) for n in decodeLoadOptionOrder(self.data)
+                )
+            )
+        if (self.vendorUUID, self.name) in SIGNATURE_DATABASE_VARIABLES:
+            try:
+                sdb = SignatureDatabase.deserialize(self.data)
+            except Exception as e:
+                print("Signatures:          cannot decode: %s" % e)
+            else:
+                print("Signatures:          %s" % len(sdb))
+                sdb.print()
         hexdump(io.BytesIO(self.data), elide=True)
         print("")
         return True
 
 
-def cmdDump(args):
-    with open(args["input-file"], "rb") as f:
-        fvh = FirmwareVolumeHeader.deserialize(f)
-        fvh.print()
+SIGNATURE_TYPES = {
+    gEfiCertSha1Guid: "SHA1",
+    gEfiCertSha256Guid: "SHA256",
+    gEfiCertSha384Guid: "SHA384",
+    gEfiCertSha512Guid: "SHA512",
+    gEfiCertRsa2048Guid: "RSA2048",
+    gEfiCertX509Guid: "X509",
+    gEfiCertX509Sha256Guid: "X509_SHA256",
+    gEfiCertX509Sha384Guid: "X509_SHA384",
+    gEfiCertX509Sha512Guid: "X509_SHA512",
+}
+
+SIGNATURE_DATABASE_VARIABLES = {
+    (gEfiGlobalVariableGuid, "PK"),
+    (gEfiGlobalVariableGuid, "KEK"),
+    (gEfiGlobalVariableGuid, "PKDefault"),
+    (gEfiGlobalVariableGuid, "KEKDefault"),
+    (gEfiGlobalVariableGuid, "dbDefault"),
+    (gEfiGlobalVariableGuid, "dbxDefault"),
+    (gEfiImageSecurityDatabaseGuid, "db"),
+    (gEfiImageSecurityDatabaseGuid, "dbx"),
+    (gEfiImageSecurityDatabaseGuid, "dbt"),
+    (gEfiImageSecurityDatabaseGuid, "dbr"),
+}
+
+SIGNATURE_LIST_HEADER_STRUCT = struct.Struct("<16sIII")
+
+
+class SignatureList(object):
+    # EFI_SIGNATURE_LIST. Each signature is an (owner UUID, data) tuple.
+    @classmethod
+    def deserializeFrom(cls, buf, offset=0):
+        o = cls()
+        (
+            o.sigType,
+            o.listSize,
+            o.headerSize,
+            o.sigSize,
+        ) = SIGNATURE_LIST_HEADER_STRUCT.unpack_from(buf, offset)
+        o.sigType = uuid.UUID(bytes=o.sigType)
+
+        start = offset + SIGNATURE_LIST_HEADER_STRUCT.size
+        end = offset + o.listSize
+        if o.listSize < SIGNATURE_LIST_HEADER_STRUCT.size or end > len(buf):
+            raise Exception("bad EFI_SIGNATURE_LIST size at 0x%x" % offset)
+        if o.sigSize < 16:
+            raise Exception("bad EFI_SIGNATURE_LIST signature size at 0x%x" % offset)
+        if (o.listSize - SIGNATURE_LIST_HEADER_STRUCT.size - o.headerSize) % o.sigSize:
+            raise Exception("EFI_SIGNATURE_LIST at 0x%x has a partial entry" % offset)
+
+        buf = bytes(buf[start:end])
+        o.header = buf[: o.headerSize]
+        o.signatures = [
+            (uuid.UUID(bytes=buf[i : i + 16]), buf[i + 16 : i + o.sigSize])
+            for i in range(o.headerSize, len(buf), o.sigSize)
+        ]
+        return o
 
-        vsh = VariableStoreHeader.deserialize(f)
-        vsh.print()
+    def serialize(self):
+        b = SIGNATURE_LIST_HEADER_STRUCT.pack(
+            self.sigType.bytes,
+            SIGNATURE_LIST_HEADER_STRUCT.size
+            + len(self.header)
+            + self.sigSize * len(self.signatures),
+            len(self.header),
+            self.sigSize,
+        )
+        b += self.header
+        for owner, data in self.signatures:
+            assert len(data) + 16 == self.sigSize
+            b += owner.bytes + data
+        return b
 
-        while True:
-            av = AuthenticatedVariable.deserialize(f)
+    @property
+    def typeName(self):
+        return SIGNATURE_TYPES.get(self.sigType, str(self.sigType))
+
+
+class SignatureDatabase(object):
+    # The EFI_SIGNATURE_LISTs making up the value of db, dbx, KEK, PK etc.,
+    # indexed for fast membership queries. Hashes are indexed by their value,
+    # and X.509 certificates by both their DER encoding and its SHA-256
+    # fingerprint.
+    def __init__(self, lists=()):
+        self.lists = []
+        self.index = {}
+        self.byOwner = {}
+        for sl in lists:
+            self.add(sl)
+
+    @classmethod
+    def deserialize(cls, data):
+        o = cls()
+        offset = 0
+        while offset < len(data):
+            sl = SignatureList.deserializeFrom(data, offset)
+            o.add(sl)
+            offset += sl.listSize
+        return o
+
+    def add(self, sl):
+        self.lists.append(sl)
+        for owner, data in sl.signatures:
+            e = (sl.sigType, owner, data)
+            self.index.setdefault(data, []).append(e)
+            if sl.sigType == gEfiCertX509Guid:
+                self.index.setdefault(hashlib.sha256(data).digest(), []).append(e)
+            self.byOwner.setdefault(owner, []).append(e)
+
+    def __len__(self):
+        return sum(len(sl.signatures) for sl in self.lists)
+
+    def __contains__(self, digest):
+        return digest in self.index
+
+    def lookup(self, digest):
+        return self.index.get(digest, [])
+
+    def query(self, digests):
+        # Returns the subset of digests which are present.
+        return self.index.keys() & set(digests)
+
+    def print(self):
+        for sl in self.lists:
+            for owner, data in sl.signatures:
+                if sl.sigType == gEfiCertX509Guid:
+                    desc = "%s bytes, SHA-256 fingerprint %s" % (
+                        len(data),
+                        hashlib.sha256(data).hexdigest(),
+                    )
+                else:
+                    desc = binascii.hexlify(data).decode("ascii")
+                print("  %-11s %s  %s" % (sl.typeName, resolveUUID(owner), desc))
+
+
+WIN_CERTIFICATE_UEFI_GUID_STRUCT = struct.Struct("<IHH16s")
+WIN_CERT_TYPE_EFI_GUID = 0x0EF1
+
+
+def parseAuthenticationHeader(b):
+    # Splits an authenticated variable write (EFI_VARIABLE_AUTHENTICATION_2
+    # followed by the payload, as produced by sign-efi-sig-list) into the
+    # timestamp and the payload. Returns None if b isn't one.
+    n = 16 + WIN_CERTIFICATE_UEFI_GUID_STRUCT.size
+    if len(b) < n:
+        return None
+    dwLength, wRevision, wCertificateType, certType = (
+        WIN_CERTIFICATE_UEFI_GUID_STRUCT.unpack_from(b, 16)
+    )
+    if (
+        wCertificateType != WIN_CERT_TYPE_EFI_GUID
+        or uuid.UUID(bytes=certType) != gEfiCertPkcs7Guid
+        or 16 + dwLength > len(b)
+    ):
+        return None
+    return UEFITime.deserialize(b[:16]), b[16 + dwLength :]
+
+
+def x509SignatureList(certs, owner):
+    lists = []
+    for cert in certs:
+        sl = SignatureList()
+        sl.sigType = gEfiCertX509Guid
+        sl.header = b""
+        sl.sigSize = 16 + len(cert)
+        sl.signatures = [(owner, cert)]
+        lists.append(sl.serialize())
+    return b"".join(lists)
+
+
+def hashSignatureList(digests, owner):
+    sl = SignatureList()
+    sl.sigType = gEfiCertSha256Guid
+    sl.header = b""
+    sl.sigSize = 16 + 32
+    sl.signatures = [(owner, d) for d in digests]
+    return sl.serialize()
+
+
+class EnrollmentPayloads(object):
+    # Builds the values of PK, KEK, db and dbx from certificate, signature
+    # list and signed .auth files. They are built once per run and the same
+    # values are then enrolled into every store.
+    def __init__(self, owner):
+        self.owner = owner
+
+    def load(self, filename):
+        # Returns (timestamp or None, EFI_SIGNATURE_LIST data).
+        with open(filename, "rb") as f:
+            b = f.read()
+
+        auth = parseAuthenticationHeader(b)
+        if auth:
+            SignatureDatabase.deserialize(auth[1])
+            return auth
+
+        if b.lstrip().startswith(b"-----BEGIN"):
+            certs = [
+                base64.b64decode(m)
+                for m in re.findall(
+                    rb"-----BEGIN CERTIFICATE-----(.*?)-----END CERTIFICATE-----",
+                    b,
+                    re.S,
+                )
+            ]
+            if not certs:
+                raise Exception("%s: no certificates found" % filename)
+            return None, x509SignatureList(certs, self.owner)
+
+        if b[:1] == b"\x30":
+            return None, x509SignatureList([b], self.owner)
+
+        try:
+            SignatureDatabase.deserialize(b)
+        except Exception:
+            raise Exception(
+                "%s: not a certificate, signature list or .auth file" % filename
+            )
+        return None, b
+
+    def hashes(self, digests):
+        return None, hashSignatureList(sorted(digests), self.owner)
+
+
+def enrollFile(filename, entries):
+    # entries is a list of (vendor UUID, name, document entry) to set.
+    try:
+        with VariableStore.open(filename, writable=True) as vs:
+            for vendorUUID, name, x in entries:
+                vs.setVariable(
+                    AuthenticatedVariable.deserializeFromDocument(
+                        str(vendorUUID), name, x
+                    )
+                )
+    except Exception as e:
+        return filename, [], str(e)
+
+    return filename, [(filename, "enrolled")], None
+
+
+DEVICE_PATH_NODE_HEADER_STRUCT = struct.Struct("<BBH")
+LOAD_OPTION_HEADER_STRUCT = struct.Struct("<IH")
+LOAD_OPTION_RE = re.compile(r"^(Boot|Driver|SysPrep|PlatformRecovery)[0-9A-F]{4}$")
+LOAD_OPTION_ORDER_RE = re.compile(r"^(Boot|Driver|SysPrep)Order$")
+
+
+def guidToText(b):
+    u = uuid.UUID(bytes=bytes(b))
+    name = resolveUUID(u)
+    if name != str(u):
+        return name
+    return str(uuid.UUID(bytes_le=bytes(b))).upper()
+
+
+def ipv4ToText(b):
+    return ".".join(str(x) for x in b)
+
+
+def ipaddressToText(b):
+    return ":".join("%x" % x for x in struct.unpack(">8H", bytes(b)))
+
+
+def devicePathNodeToText(t, st, d):
+    if t == 0x01 and st == 0x01 and len(d) >= 2:
+        return "Pci(0x%x,0x%x)" % (d[1], d[0])
+    if t == 0x01 and st == 0x04 and len(d) >= 16:
+        return "VenHw(%s)" % guidToText(d[:16])
+    if t == 0x02 and st == 0x01 and len(d) >= 8:
+        hid, uid = struct.unpack_from("<II", d)
+        if hid & 0xFFFF == 0x41D0:
+            if hid >> 16 == 0x0A03:
+                return "PciRoot(0x%x)" % uid
+            if hid >> 16 == 0x0A08:
+                return "PcieRoot(0x%x)" % uid
+            return "Acpi(PNP%04X,0x%x)" % (hid >> 16, uid)
+        return "Acpi(0x%08x,0x%x)" % (hid, uid)
+    if t == 0x03 and st == 0x01 and len(d) >= 4:
+        return "Ata(%s,%s,0x%x)" % (
+            ("Primary", "Secondary")[d[0] & 1],
+            ("Master", "Slave")[d[1] & 1],
+            struct.unpack_from("<H", d, 2)[0],
+        )
+    if t == 0x03 and st == 0x02 and len(d) >= 4:
+        return "Scsi(0x%x,0x%x)" % struct.unpack_from("<HH", d)
+    if t == 0x03 and st == 0x05 and len(d) >= 2:
+        return "USB(0x%x,0x%x)" % (d[0], d[1])
+    if t == 0x03 and st == 0x0A and len(d) >= 16:
+        return "VenMsg(%s)" % guidToText(d[:16])
+    if t == 0x03 and st == 0x0B and len(d) >= 33:
+        return "MAC(%s,0x%x)" % (binascii.hexlify(d[:6]).decode("ascii"), d[32])
+    if t == 0x03 and st == 0x0C and len(d) >= 15:
+        return "IPv4(%s,%s,%s)" % (
+            ipv4ToText(d[4:8]),
+            "Static" if d[14] else "DHCP",
+            ipv4ToText(d[0:4]),
+        )
+    if t == 0x03 and st == 0x0D and len(d) >= 32:
+        return "IPv6(%s)" % ipaddressToText(d[16:32])
+    if t == 0x03 and st == 0x12 and len(d) >= 6:
+        return "Sata(0x%x,0x%x,0x%x)" % struct.unpack_from("<HHH", d)
+    if t == 0x03 and st == 0x17 and len(d) >= 12:
+        return "NVMe(0x%x,%s)" % (
+            struct.unpack_from("<I", d)[0],
+            "-".join("%02X" % x for x in d[4:12]),
+        )
+    if t == 0x03 and st == 0x18:
+        return "Uri(%s)" % bytes(d).decode("utf-8", "replace")
+    if t == 0x04 and st == 0x01 and len(d) >= 38:
+        partNum, start, size = struct.unpack_from("<IQQ", d)
+        fmt, sigType = d[36], d[37]
+        if sigType == 2:
+            sig = str(uuid.UUID(bytes_le=bytes(d[20:36]))).upper()
+        else:
+            sig = "0x%08x" % struct.unpack_from("<I", d, 20)[0]
+        return "HD(%s,%s,%s,0x%x,0x%x)" % (
+            partNum,
+            {1: "MBR", 2: "GPT"}.get(fmt, fmt),
+            sig,
+            start,
+            size,
+        )
+    if t == 0x04 and st == 0x02 and len(d) >= 20:
+        return "CDROM(0x%x,0x%x,0x%x)" % struct.unpack_from("<IQQ", d)
+    if t == 0x04 and st == 0x03 and len(d) >= 16:
+        return "VenMedia(%s)" % guidToText(d[:16])
+    if t == 0x04 and st == 0x04:
+        return str(bytes(d), "utf-16le").rstrip("\0")
+    if t == 0x04 and st == 0x06 and len(d) >= 16:
+        return "FvFile(%s)" % guidToText(d[:16])
+    if t == 0x04 and st == 0x07 and len(d) >= 16:
+        return "Fv(%s)" % guidToText(d[:16])
+    if t == 0x04 and st == 0x08 and len(d) >= 20:
+        return "Offset(0x%x,0x%x)" % struct.unpack_from("<QQ", d, 4)
+    if t == 0x05 and st == 0x01 and len(d) >= 4:
+        return "BBS(0x%x,%s)" % (
+            struct.unpack_from("<H", d)[0],
+            bytes(d[4:]).rstrip(b"\0").decode("ascii", "replace"),
+        )
+    return "Path(%s,%s,%s)" % (t, st, binascii.hexlify(d).decode("ascii"))
+
+
+def decodeDevicePath(b):
+    # Returns a list of (type, subtype, data) nodes, with the end of instance
+    # nodes kept and the final end node dropped.
+    nodes = []
+    offset = 0
+    while offset + DEVICE_PATH_NODE_HEADER_STRUCT.size <= len(b):
+        t, st, L = DEVICE_PATH_NODE_HEADER_STRUCT.unpack_from(b, offset)
+        if L < DEVICE_PATH_NODE_HEADER_STRUCT.size or offset + L > len(b):
+            raise Exception("bad device path node at 0x%x" % offset)
+        if t == 0x7F and st == 0xFF:
+            break
+        nodes.append((t, st, bytes(b[offset + 4 : offset + L])))
+        offset += L
+    return nodes
+
+
+def devicePathToText(nodes):
+    s = ""
+    for t, st, d in nodes:
+        if t == 0x7F:
+            s += ","
+            continue
+        if s and not s.endswith(","):
+            s += "/"
+        s += devicePathNodeToText(t, st, d)
+    return s
+
+
+class LoadOption(object):
+    # EFI_LOAD_OPTION, as stored in Boot####, Driver#### etc. Instances
+    # returned by decodeLoadOption() are shared and must not be modified.
+    @classmethod
+    def deserialize(cls, b):
+        o = cls()
+        if len(b) < LOAD_OPTION_HEADER_STRUCT.size:
+            raise Exception("load option too short")
+        o.attributes, filePathLen = LOAD_OPTION_HEADER_STRUCT.unpack_from(b)
+        offset = LOAD_OPTION_HEADER_STRUCT.size
+        end = offset
+        while end + 1 < len(b) and b[end : end + 2] != b"\0\0":
+            end += 2
+        if end + 1 >= len(b):
+            raise Exception("unterminated load option description")
+        o.description = str(bytes(b[offset:end]), "utf-16le")
+        offset = end + 2
+        if offset + filePathLen > len(b):
+            raise Exception("load option device path extends past end of data")
+        o.filePath = bytes(b[offset : offset + filePathLen])
+        o.optionalData = bytes(b[offset + filePathLen :])
+        o.nodes = decodeDevicePath(o.filePath)
+        return o
+
+    @property
+    def isActive(self):
+        return bool(self.attributes & 0x1)
+
+    @property
+    def text(self):
+        return devicePathToText(self.nodes)
+
+    @property
+    def bootClass(self):
+        # A rough classification of what the option boots from: http, pxe,
+        # cdrom, disk, app or other.
+        kinds = set((t, st) for t, st, _ in self.nodes)
+        desc = self.description.upper()
+        if (0x03, 0x18) in kinds or "HTTP" in desc:
+            return "http"
+        if (0x03, 0x0B) in kinds or "PXE" in desc:
+            return "pxe"
+        if (0x04, 0x02) in kinds or re.search(r"DVD|CD-?ROM", desc):
+            return "cdrom"
+        if kinds & {(0x04, 0x01), (0x03, 0x01), (0x03, 0x02), (0x03, 0x12)}:
+            return "disk"
+        if kinds & {(0x03, 0x17)} or re.search(r"HARDDISK|HARD DRIVE|MISC DEVICE", desc):
+            return "disk"
+        if (0x04, 0x06) in kinds:
+            return "app"
+        return "other"
+
+
+@functools.lru_cache(maxsize=4096)
+def decodeLoadOption(data):
+    # Load options repeat heavily across stores, so decoded options are
+    # memoized by their data.
+    return LoadOption.deserialize(data)
+
+
+def loadOptionClass(data):
+    # The bootClass of a load option, or "other" if it can't be decoded.
+    try:
+        return decodeLoadOption(data).bootClass
+    except Exception:
+        return "other"
+
+
+def decodeLoadOptionOrder(data):
+    return list(struct.unpack("<%dH" % (len(data) // 2), data[: len(data) & ~1]))
+
+
+def encodeLoadOptionOrder(order):
+    return struct.pack("<%dH" % len(order), *order)
+
+
+def findVariableStore(buf):
+    # Returns the offset of the variable store firmware volume in buf, which
+    # may be a combined code and variables image, by searching for the FV
+    # header signature.
+    if isinstance(buf, memoryview):
+        if buf.obj is not None and len(buf.obj) == buf.nbytes:
+            buf = buf.obj
+        else:
+            buf = buf.tobytes()
+
+    magicOffset = 40
+    magic = struct.pack("<I", FV_MAGIC)
+    fsUUID = gEfiSystemNvDataFvGuid.bytes
+    pos = magicOffset
+    while True:
+        pos = buf.find(magic, pos)
+        if pos < 0:
+            raise Exception("no variable store firmware volume found")
+        start = pos - magicOffset
+        if buf[start + 16 : start + 32] == fsUUID:
+            return start
+        pos += 1
+
+
+class VariableStore(object):
+    def __init__(self, buf, offset=None, strict=True):
+        # Unless strict is set, a variable store header which isn't marked
+        # formatted and healthy is accepted.
+        self._mmap = None
+        self.skipped = []
+        self.buf = memoryview(buf)
+        try:
+            if offset is None:
+                offset = findVariableStore(self.buf)
+            self.offset = offset
+            self.fvh = FirmwareVolumeHeader.deserializeFrom(self.buf, offset)
+            self.vshOffset = offset + self.fvh.hdrLen
+            self.vsh = VariableStoreHeader.deserializeFrom(
+                self.buf, self.vshOffset, strict
+            )
+        except:
+            self.buf.release()
+            raise
+
+        self.varOffset = self.vshOffset + VARIABLE_STORE_HEADER_STRUCT.size
+        self.varLimit = min(self.vshOffset + self.vsh.len, len(self.buf))
+        # Records refer to this view rather than buf, so that they stay
+        # usable after the store is closed.
+        self._recordView = self.buf[:]
+
+    @classmethod
+    def open(cls, filename, writable=False):
+        with open(filename, "r+b" if writable else "rb") as f:
+            m = mmap.mmap(
+                f.fileno(),
+                0,
+                access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ,
+            )
+
+        try:
+            o = cls(m)
+        except:
+            m.close()
+            raise
+
+        o._mmap = m
+        return o
+
+    def variables(self, resync=False):
+        # With resync set, a record which can't be parsed is skipped by
+        # searching for the next plausible record header; the regions skipped
+        # are appended to self.skipped as (offset, length).
+        offset = self.varOffset
+        while offset + AUTHENTICATED_VARIABLE_HEADER_STRUCT.size <= self.varLimit:
+            try:
+                av = AuthenticatedVariable.deserializeFrom(self._recordView, offset)
+                if av and resync and not self._plausibleHeader(offset):
+                    raise Exception("implausible variable header at 0x%x" % offset)
+            except Exception:
+                if not resync:
+                    raise
+                nextOffset = self._nextHeader(offset + 4)
+                self.skipped.append((offset, (nextOffset or self.varLimit) - offset))
+                if nextOffset is None:
+                    break
+                offset = nextOffset
+                continue
             if not av:
                 break
-            if not av.isDeleted or args.get("deleted"):
-                av.print()
+            yield av
+            offset += av.size
+
+    def _plausibleHeader(self, offset):
+        if offset + AUTHENTICATED_VARIABLE_HEADER_STRUCT.size > self.varLimit:
+            return False
+        state = self.buf[offset + 2]
+        nameLen, dataLen = struct.unpack_from("<II", self.buf, offset + 36)
+        end = offset + AUTHENTICATED_VARIABLE_HEADER_STRUCT.size + nameLen + dataLen
+        return (
+            not state & VAR_STATE_HEADER_VALID
+            and nameLen >= 2
+            and not nameLen % 2
+            and end <= self.varLimit
+            and self.buf[end - dataLen - 2 : end - dataLen] == b"\0\0"
+        )
+
+    def _nextHeader(self, start):
+        # Searches for the magic of a plausible record header at an aligned
+        # offset from start.
+        start += -(start - self.offset) & 3
+        b = bytes(self.buf[start : self.varLimit])
+        pos = 0
+        while True:
+            pos = b.find(b"\xAA\x55", pos)
+            if pos < 0:
+                return None
+            offset = start + pos
+            if not pos & 3 and self._plausibleHeader(offset):
+                return offset
+            pos += 1
+
+    def _headers(self):
+        # Yields (offset, state, nameLen, dataLen) for each record, reading
+        # only the fixed-size part of its header.
+        hdrSize = AUTHENTICATED_VARIABLE_HEADER_STRUCT.size
+        buf = self._recordView
+        offset = self.varOffset
+        while offset + hdrSize <= self.varLimit:
+            magic, state = struct.unpack_from("<HB", buf, offset)
+            if magic != 0x55AA:
+                # Let deserializeFrom() decide between end of store and error.
+                AuthenticatedVariable.deserializeFrom(buf, offset)
+                return
+            nameLen, dataLen = struct.unpack_from("<II", buf, offset + 36)
+            if offset + hdrSize + nameLen + dataLen > len(buf):
+                raise Exception("variable at 0x%x extends past end of store" % offset)
+            yield offset, state, nameLen, dataLen
+            offset += (hdrSize + nameLen + dataLen + 3) & ~3
+
+    def _matchesRaw(self, offset, nameLen, rawVendor, rawName):
+        # Compares the vendor GUID and name of the record at offset against
+        # their raw encodings (None matching anything) without decoding them.
+        nameOffset = offset + AUTHENTICATED_VARIABLE_HEADER_STRUCT.size
+        buf = self._recordView
+        return (rawVendor is None or buf[offset + 44 : nameOffset] == rawVendor) and (
+            rawName is None
+            or (
+                nameLen == len(rawName)
+                and buf[nameOffset : nameOffset + nameLen] == rawName
+            )
+        )
+
+    def iterVariables(self, vendorUUID=None, name=None, includeDeleted=False):
+        # Like variables(), but the filters are checked against the raw
+        # header, so records which don't match are skipped without building
+        # an AuthenticatedVariable or decoding their name. Unless
+        # includeDeleted is set, only live records are yielded, as EDK2 sees
+        # them: a record in deleted transition is skipped if the added record
+        # which replaced it exists.
+        rawVendor = vendorUUID.bytes if vendorUUID is not None else None
+        rawName = name.encode("utf-16le") + b"\0\0" if name is not None else None
+        superseded = None
+        for offset, state, nameLen, _ in self._headers():
+            if not includeDeleted:
+                if not isLiveState(state):
+                    continue
+                if not state & VAR_STATE_IN_DELETED_TRANSITION:
+                    if superseded is None:
+                        superseded = self._supersededRecords()
+                    if offset in superseded:
+                        continue
+            if self._matchesRaw(offset, nameLen, rawVendor, rawName):
+                yield AuthenticatedVariable.deserializeFrom(self._recordView, offset)
+
+    def _supersededRecords(self):
+        # Returns the offsets of live records in deleted transition for which
+        # there is also a live record that isn't.
+        hdrSize = AUTHENTICATED_VARIABLE_HEADER_STRUCT.size
+        buf = self._recordView
+        added = set()
+        transition = []
+        for offset, state, nameLen, _ in self._headers():
+            if not isLiveState(state):
+                continue
+            k = bytes(buf[offset + 44 : offset + hdrSize + nameLen])
+            if state & VAR_STATE_IN_DELETED_TRANSITION:
+                added.add(k)
+            else:
+                transition.append((offset, k))
+        return set(offset for offset, k in transition if k in added)
+
+    @property
+    def usedLimit(self):
+        end = self.varOffset
+        hdrSize = AUTHENTICATED_VARIABLE_HEADER_STRUCT.size
+        for offset, _, nameLen, dataLen in self._headers():
+            end = offset + ((hdrSize + nameLen + dataLen + 3) & ~3)
+        return end
+
+    def findVariables(self, vendorUUID, name):
+        return self._findVariables(vendorUUID, name)[0]
+
+    def _findVariables(self, vendorUUID, name):
+        # Returns the live records for the variable and the end of the used
+        # region, in a single walk of the store.
+        rawVendor = vendorUUID.bytes
+        rawName = name.encode("utf-16le") + b"\0\0"
+        hdrSize = AUTHENTICATED_VARIABLE_HEADER_STRUCT.size
+        avs = []
+        end = self.varOffset
+        for offset, state, nameLen, dataLen in self._headers():
+            end = offset + ((hdrSize + nameLen + dataLen + 3) & ~3)
+            if isLiveState(state) and self._matchesRaw(
+                offset, nameLen, rawVendor, rawName
+            ):
+                avs.append(
+                    AuthenticatedVariable.deserializeFrom(self._recordView, offset)
+                )
+        return avs, end
+
+    def deleteVariable(self, vendorUUID, name):
+        avs = self.findVariables(vendorUUID, name)
+        for av in avs:
+            self._setState(av, VAR_DELETED)
+        return len(avs)
+
+    def setVariable(self, av, reclaim=False):
+        av.offset = self.setRecord(av.vendorUUID, av.name, av.serialize(), reclaim)
+        av.state = VAR_ADDED
+        return av
+
+    def setRecord(self, vendorUUID, name, b, reclaim=False):
+        # Appends the serialized record b and then invalidates any old record
+        # for the variable, in the same order as EDK2 so that an interrupted
+        # update is recoverable. If reclaim is set and the store is full, it
+        # is compacted in place first, which is only safe for in-memory
+        # buffers. Returns the offset of the new record.
+        old, offset = self._findVariables(vendorUUID, name)
+        if offset + len(b) > self.varLimit and reclaim:
+            image, _ = self.reclaim()
+            self.buf[:] = image
+            old, offset = self._findVariables(vendorUUID, name)
+
+        if offset + len(b) > self.varLimit:
+            raise Exception("not enough space in variable store")
+        if self.buf[offset : offset + len(b)] != b"\xFF" * len(b):
+            raise Exception("free space at 0x%x is not erased" % offset)
+
+        for o in old:
+            self._setState(o, VAR_IN_DELETED_TRANSITION)
+
+        # The record is written with its header marked valid only, so that
+        # if the write is torn the firmware drops it rather than trusting it.
+        b = bytearray(b)
+        b[2] = VAR_HEADER_VALID_ONLY
+        self.buf[offset : offset + len(b)] = b
+        self._flush(offset, len(b))
+        self.buf[offset + 2] = VAR_ADDED
+        self._flush(offset + 2, 1)
+
+        for o in old:
+            self._setState(o, VAR_DELETED)
+
+        return offset
+
+    def reclaim(self, resync=False):
+        # Returns a copy of the image with the variable region compacted down
+        # to the live records, and the end of the used region in the copy.
+        # Records still in deleted transition are kept (as EDK2 does) unless
+        # an added record for the same variable supersedes them.
+        live = []
+        added = set()
+        for av in self.variables(resync):
+            if av.isDeleted:
+                continue
+            live.append(av)
+            if not av.inDeletedTransition:
+                added.add((av.vendorUUID, av.name))
+
+        image = bytearray(self.buf)
+        image[self.varOffset : self.varLimit] = b"\xFF" * (
+            self.varLimit - self.varOffset
+        )
+
+        offset = self.varOffset
+        for av in live:
+            if av.inDeletedTransition and (av.vendorUUID, av.name) in added:
+                continue
+
+            n = AUTHENTICATED_VARIABLE_HEADER_STRUCT.size + av.nameLen + av.dataLen
+            image[offset : offset + n] = self.buf[av.offset : av.offset + n]
+            image[offset + 2] = VAR_ADDED
+            offset += av.size
+
+        return image, offset
+
+    def _setState(self, av, state):
+        offset = av.offset + 2
+        self.buf[offset] &= state
+        av.state = self.buf[offset]
+        self._flush(offset, 1)
+
+    def _flush(self, offset, size):
+        if self._mmap is not None:
+            start = offset - (offset % mmap.ALLOCATIONGRANULARITY)
+            self._mmap.flush(start, offset + size - start)
+
+    def close(self):
+        self.buf.release()
+        self._recordView = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Variables still refer to the mapping; it is unmapped
+                # once the last of them goes away.
+                pass
+            self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def cmdDump(args):
+    with VariableStore.open(args["input-file"]) as vs:
+        if vs.offset:
+            print("Variable store found at offset 0x%x" % vs.offset)
+            print("")
+        vs.fvh.print()
+        vs.vsh.print()
+
+        for av in vs.iterVariables(includeDeleted=args.get("deleted")):
+            av.print()
 
     return 0
 
 
+def iterVariables(source, vendor=None, name=None, includeDeleted=False):
+    # Yields the variables in source, which is either a filename or a buffer
+    # holding a variables (or combined) image, optionally only those with the
+    # given vendor (a UUID or registered name) and name. Variables read from
+    # a file are copied out of it, as the file is closed when the generator
+    # finishes; those read from a buffer refer to it until accessed.
+    if isinstance(vendor, str):
+        vendor = lookupUUID(vendor)
+
+    if isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+        vs = VariableStore(source)
+        try:
+            yield from vs.iterVariables(vendor, name, includeDeleted)
+        finally:
+            vs.close()
+        return
+
+    with VariableStore.open(source) as vs:
+        for av in vs.iterVariables(vendor, name, includeDeleted):
+            yield av.detach()
+
+
+def variableToDocument(av):
+    x = {}
+    x["Data"] = av.data
+    if av.monotonicCount:
+        x["Monotonic Count"] = av.monotonicCount
+    if av.pubKeyIdx:
+        x["Public Key Index"] = av.pubKeyIdx
+    if not (av.flags & 0x1):
+        x["Volatile"] = True
+    if av.flags & 0x2:
+        x["Boot Access"] = True
+    if av.flags & 0x4:
+        x["Runtime Access"] = True
+    if av.flags & 0x8:
+        x["Hardware Error Record"] = True
+    if av.flags & 0x10:
+        x["Authenticated Write Access"] = True
+    if av.flags & 0x20:
+        x["Time Based Authenticated Write Access"] = True
+    if av.flags & 0x40:
+        x["Append Write"] = True
+
+    flags = av.flags & ~(0x1 | 0x2 | 0x4 | 0x8 | 0x10 | 0x20 | 0x40)
+    if flags:
+        x["Flags"] = flags
+
+    t = av.timestamp.time
+    if t:
+        x["Timestamp"] = t
+
+    return x
+
+
+def jsonDefault(o):
+    # Binary data and timestamps, which JSON has no types for, are encoded as
+    # single-key objects named after the YAML tags used for them.
+    if isinstance(o, (bytes, bytearray, memoryview)):
+        return {"!!binary": base64.b64encode(o).decode("ascii")}
+    if isinstance(o, datetime.datetime):
+        return {"!!timestamp": o.isoformat()}
+    raise TypeError("cannot encode %r as JSON" % type(o))
+
+
+def jsonObjectHook(o):
+    if len(o) == 1:
+        if "!!binary" in o:
+            return base64.b64decode(o["!!binary"])
+        if "!!timestamp" in o:
+            return datetime.datetime.fromisoformat(o["!!timestamp"])
+    return o
+
+
+def importMsgpack():
+    try:
+        import msgpack
+    except ImportError:
+        raise Exception("the msgpack format requires the msgpack package")
+    return msgpack
+
+
+def guessDocumentFormat(filename):
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == ".json":
+        return "json"
+    if ext in (".msgpack", ".mpk"):
+        return "msgpack"
+    return "yaml"
+
+
+def loadDocument(f, fmt="yaml"):
+    # f must be opened in binary mode.
+    if fmt == "json":
+        return json.load(f, object_hook=jsonObjectHook)
+    if fmt == "msgpack":
+        return importMsgpack().unpack(f, timestamp=3)
+    return yaml.load(f, Loader=YAMLLoader)
+
+
+def dumpDocument(doc, f, fmt="yaml"):
+    # f must be opened in binary mode.
+    if fmt == "json":
+        f.write(json.dumps(doc, default=jsonDefault).encode("utf-8") + b"\n")
+    elif fmt == "msgpack":
+        f.write(importMsgpack().packb(doc, datetime=True))
+    else:
+        f.write(yaml.dump(doc, Dumper=YAMLDumper).encode("utf-8") + b"\n")
+
+
+def encodeNdjsonData(x, encoding):
+    data = x.pop("Data")
+    x["Data Length"] = len(data)
+    if encoding == "hex":
+        x["Data Hex"] = binascii.hexlify(data).decode("ascii")
+    elif encoding == "sha256":
+        x["Data SHA256"] = hashlib.sha256(data).hexdigest()
+    else:
+        x["Data"] = data
+    return x
+
+
+def exportNdjson(filenames, out, encoding="base64"):
+    # Writes a file record followed by one record per variable for each file,
+    # as the stores are walked, so that memory use doesn't depend on the
+    # number or size of files.
+    rc = 0
+    for filename in filenames:
+        try:
+            with VariableStore.open(filename) as vs:
+                rec = {
+                    "Type": "file",
+                    "File": filename,
+                    "Offset": vs.offset,
+                    "Store Length": vs.vsh.len,
+                }
+                out.write(json.dumps(rec) + "\n")
+                for av in vs.iterVariables():
+                    rec = {
+                        "Type": "variable",
+                        "File": filename,
+                        "Vendor": resolveUUID(av.vendorUUID),
+                        "Name": av.name,
+                    }
+                    rec.update(encodeNdjsonData(variableToDocument(av), encoding))
+                    out.write(json.dumps(rec, default=jsonDefault) + "\n")
+        except BrokenPipeError:
+            raise
+        except Exception as e:
+            print("%s: %s" % (filename, e), file=sys.stderr)
+            rc = 1
+        out.flush()
+    return rc
+
+
 def cmdExport(args):
+    if args.get("ndjson"):
+        files = findVarsFiles(args["input-file"], args["pattern"])
+        try:
+            return exportNdjson(files, sys.stdout, args["data_encoding"])
+        except BrokenPipeError:
+            # The reader went away (e.g. head); stop quietly, making sure the
+            # final flush at exit doesn't fail again.
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            return 1
+
+    if len(args["input-file"]) != 1:
+        print("Only --ndjson accepts more than one input file", file=sys.stderr)
+        return 1
+
+    blobs = BlobStore(args["blob_dir"]) if args.get("blob_dir") else None
+
     doc = dict(Variables={})
     docVars = doc["Variables"]
 
-    with open(args["input-file"], "rb") as f:
-        fvh = FirmwareVolumeHeader.deserialize(f)
-        vsh = VariableStoreHeader.deserialize(f)
-        while True:
-            av = AuthenticatedVariable.deserialize(f)
-            if not av:
-                break
-            if av.isDeleted:
-                continue
+    with VariableStore.open(args["input-file"][0]) as vs:
+        for av in vs.iterVariables():
             k = resolveUUID(av.vendorUUID)
             docVars.setdefault(k, {})
-            docVars[k][av.name] = x = {}
-            x["Data"] = av.data
-            if av.monotonicCount:
-                x["Monotonic Count"] = av.monotonicCount
-            if av.pubKeyIdx:
-                x["Public Key Index"] = av.pubKeyIdx
-            if not (av.flags & 0x1):
-                x["Volatile"] = True
-            if av.flags & 0x2:
-                x["Boot Access"] = True
-            if av.flags & 0x4:
-                x["Runtime Access"] = True
-            if av.flags & 0x8:
-                x["Hardware Error Record"] = True
-            if av.flags & 0x10:
-                x["Authenticated Write Access"] = True
-            if av.flags & 0x20:
-                x["Time Based Authenticated Write Access"] = True
-            if av.flags & 0x40:
-                x["Append Write"] = True
-
-            flags = av.flags & ~(0x1 | 0x2 | 0x4 | 0x8 | 0x10 | 0x20 | 0x40)
-            if flags:
-                x["Flags"] = flags
-
-            t = av.timestamp.time
-            if t:
-                x["Timestamp"] = t
+            x = variableToDocument(av)
+            if blobs is not None:
+                x = blobs.externalize(x, args["blob_threshold"])
+            docVars[k][av.name] = x
 
-    print(yaml.dump(doc))
+    dumpDocument(doc, sys.stdout.buffer, args.get("format") or "yaml")
     return 0
 
 
-def cmdCompile(args):
-    with open(args["input-file"], "r") as f:
-        doc = yaml.safe_load(f.read())
-
-        vs = []
-        docVars = doc.get("Variables", {})
-        for vendorID in docVars.keys():
-            for name in docVars[vendorID].keys():
-                av = AuthenticatedVariable.deserializeFromDocument(
-                    vendorID, name, docVars[vendorID][name]
-                )
-                vs.append(av)
+class BlobStore(object):
+    # Content-addressed store of variable data which export moves out of the
+    # document, as files named by the SHA-256 hash of their contents. The
+    # document keeps the hash as "Data Blob" in place of "Data".
+    def __init__(self, directory):
+        self.directory = directory
+        self._loaded = {}
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def put(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            writeFileAtomically(path, data)
+        return digest
+
+    def get(self, digest):
+        data = self._loaded.get(digest)
+        if data is not None:
+            return data
+        if not re.match(r"^[0-9a-f]{64}$", digest):
+            raise Exception("bad blob reference %r" % digest)
+        with open(self.path(digest), "rb") as f:
+            data = f.read()
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise Exception("blob %s does not match its hash" % digest)
+        self._loaded[digest] = data
+        return data
+
+    def externalize(self, x, threshold):
+        if len(x["Data"]) > threshold:
+            x["Data Blob"] = self.put(x.pop("Data"))
+        return x
+
+
+def resolveDataBlob(vendorID, name, x, blobs):
+    if "Data Blob" not in x:
+        return x
+    if blobs is None:
+        raise Exception(
+            "variable %s/%s refers to a data blob, but no blob directory was given"
+            % (vendorID, name)
+        )
+    x = dict(x)
+    x["Data"] = blobs.get(x.pop("Data Blob"))
+    return x
 
-    with open(args["output-file"], "wb") as fo:
-        fm = io.BytesIO(b"\xFF" * (528 * 1024))
-        fm.write(FirmwareVolumeHeader.create().serialize())
-        fm.write(VariableStoreHeader.create().serialize())
 
-        for v in vs:
-            fm.write(v.serialize())
-            if fm.tell() % 4:
-                fm.write(b"\xFF" * (4 - (fm.tell() % 4)))
-            assert (fm.tell() % 4) == 0
+def compileVariable(vendorID, name, x, blobs=None):
+    x = resolveDataBlob(vendorID, name, x, blobs)
+    return AuthenticatedVariable.deserializeFromDocument(vendorID, name, x).serialize()
 
-        if fm.tell() > 0x41000:
+
+def compileVariables(doc, blobs=None):
+    docVars = doc.get("Variables", {})
+    for vendorID in docVars.keys():
+        for name in docVars[vendorID].keys():
+            yield compileVariable(vendorID, name, docVars[vendorID][name], blobs)
+
+
+def generateBlank(geometry=None):
+    geometry = geometry or FLASH_GEOMETRIES["4m"]
+    image = bytearray(b"\xFF" * geometry.fvLen)
+    fvh = FirmwareVolumeHeader.create(geometry)
+    b = fvh.serialize() + VariableStoreHeader.create(geometry, fvh).serialize()
+    image[0 : len(b)] = b
+    b = ftwWorkingBlockHeader(geometry.ftwSize)
+    image[geometry.ftwOffset : geometry.ftwOffset + len(b)] = b
+    return image
+
+
+def compileDocument(doc, geometry=None, blobs=None):
+    geometry = geometry or FLASH_GEOMETRIES["4m"]
+    image = generateBlank(geometry)
+    offset = FirmwareVolumeHeader.create(geometry).hdrLen
+    offset += VARIABLE_STORE_HEADER_STRUCT.size
+
+    for b in compileVariables(doc, blobs):
+        if offset + len(b) > geometry.liveSize:
             raise Exception("too many variables to fit in file")
+        image[offset : offset + len(b)] = b
+        offset += (len(b) + 3) & ~3
+
+    return image
+
+
+def compileOverlay(base, doc, blobs=None):
+    # Applies the variables in doc to a copy of the image base, leaving all of
+    # its other records untouched. A variable whose entry is null or has
+    # "Deleted" set is deleted.
+    image = bytearray(base)
+    vs = VariableStore(image)
+    docVars = doc.get("Variables", {})
+    for vendorID in docVars.keys():
+        vendorUUID = lookupUUID(vendorID)
+        for name in docVars[vendorID].keys():
+            x = docVars[vendorID][name]
+            if x is None or x.get("Deleted"):
+                vs.deleteVariable(vendorUUID, name)
+            else:
+                b = compileVariable(vendorID, name, x, blobs)
+                vs.setRecord(vendorUUID, name, b, reclaim=True)
+
+    vs.close()
+    return image
+
+
+def cmdCompile(args):
+    if args.get("base") and args.get("geometry"):
+        print("--geometry can't be used with --base", file=sys.stderr)
+        return 1
+
+    with open(args["input-file"], "rb") as f:
+        doc = loadDocument(
+            f, args.get("format") or guessDocumentFormat(args["input-file"])
+        )
+
+    blobs = BlobStore(args["blob_dir"]) if args.get("blob_dir") else None
+
+    if args.get("base"):
+        with open(args["base"], "rb") as f:
+            image = compileOverlay(f.read(), doc, blobs)
+    else:
+        image = compileDocument(doc, geometryArgument(args), blobs)
+
+    return writeImage(image, args)
+
+
+def imageToMemfd(image, name="OVMF_VARS.fd", seal=False):
+    # Returns an inheritable memfd holding image. If seal is set, the memfd
+    # is sealed against any further modification.
+    flags = os.MFD_ALLOW_SEALING if seal else 0
+    fd = os.memfd_create(name, flags)
+    try:
+        writeAll(fd, image)
+        os.lseek(fd, 0, os.SEEK_SET)
+        if seal:
+            fcntl.fcntl(
+                fd,
+                fcntl.F_ADD_SEALS,
+                fcntl.F_SEAL_SHRINK
+                | fcntl.F_SEAL_GROW
+                | fcntl.F_SEAL_WRITE
+                | fcntl.F_SEAL_SEAL,
+            )
+        os.set_inheritable(fd, True)
+    except:
+        os.close(fd)
+        raise
+    return fd
+
+
+def writeAll(fd, data):
+    data = memoryview(data)
+    while data:
+        n = os.write(fd, data)
+        data = data[n:]
+
+
+FICLONE = 0x40049409
+
+
+def cacheDirectory():
+    cacheDir = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cacheDir, "ovmfvartool")
+
+
+def defaultTemplatePath(template, filename):
+    # The template is kept next to the output file, since files can only be
+    # cloned within a filesystem.
+    return os.path.join(
+        os.path.dirname(os.path.abspath(filename)),
+        ".ovmfvartool-template-%s.fd" % hashlib.sha256(template).hexdigest()[:16],
+    )
+
+
+def cloneFile(src, dst):
+    # Makes dst share src's extents if the filesystem supports it, falling
+    # back to copy_file_range (which may still avoid copying data) and then
+    # to a plain copy.
+    try:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return "reflink"
+    except OSError:
+        pass
+
+    size = os.fstat(src.fileno()).st_size
+    try:
+        offset = 0
+        while offset < size:
+            n = os.copy_file_range(
+                src.fileno(), dst.fileno(), size - offset, offset, offset
+            )
+            if n == 0:
+                break
+            offset += n
+        return "copy_file_range"
+    except (OSError, AttributeError):
+        pass
+
+    os.ftruncate(dst.fileno(), 0)
+    os.lseek(src.fileno(), 0, os.SEEK_SET)
+    os.lseek(dst.fileno(), 0, os.SEEK_SET)
+    writeAll(dst.fileno(), os.read(src.fileno(), size))
+    return "copy"
+
+
+def writeImageReflink(image, filename, templatePath=None, blockSize=4096):
+    # Clones the template at templatePath (by default, a blank image with the
+    # same layout in the output directory; either is created if it doesn't
+    # exist) and then rewrites only the blocks where image differs from it,
+    # so that on copy-on-write filesystems the output shares most of its
+    # extents with the template. Returns the method cloneFile() used.
+    blank = None
+    if templatePath is None:
+        blank = generateBlank(FlashGeometry.fromImage(image))
+        templatePath = defaultTemplatePath(blank, filename)
+    if not os.path.exists(templatePath):
+        if blank is None:
+            blank = generateBlank(FlashGeometry.fromImage(image))
+        os.makedirs(os.path.dirname(os.path.abspath(templatePath)), exist_ok=True)
+        writeFileAtomically(templatePath, blank)
+
+    with open(templatePath, "rb") as src:
+        template = src.read()
+        if len(template) != len(image):
+            raise Exception(
+                "template %s is %s bytes, expected %s"
+                % (templatePath, len(template), len(image))
+            )
 
-        fm.seek(0x41000)
-        fm.write(
-            binascii.unhexlify(
-                b"2b29589e687c7d49a0ce6500fd9f1b952caf2c64feffffffe00f000000000000"
+        with open(filename, "wb") as dst:
+            method = cloneFile(src, dst)
+            image = memoryview(image)
+            template = memoryview(template)
+            for offset in range(0, len(image), blockSize):
+                b = image[offset : offset + blockSize]
+                if b != template[offset : offset + blockSize]:
+                    os.pwrite(dst.fileno(), b, offset)
+
+    return method
+
+
+def writeImage(image, args):
+    # The output file is "-" when writing to standard output, --fd or --memfd.
+    toFd = args.get("memfd") or args.get("fd") is not None
+    if toFd and args["output-file"] != "-":
+        print("--fd and --memfd take - as the output file", file=sys.stderr)
+        return 1
+
+    if args.get("memfd"):
+        if not args.get("exec"):
+            print("--memfd requires --exec", file=sys.stderr)
+            return 1
+        fd = imageToMemfd(image, seal=args.get("seal"))
+        cmd = [a.replace("{fd}", str(fd)) for a in args["exec"]]
+        sys.stdout.flush()
+        os.execvp(cmd[0], cmd)
+    elif args.get("fd") is not None:
+        writeAll(args["fd"], image)
+    elif args["output-file"] == "-":
+        sys.stdout.flush()
+        writeAll(sys.stdout.fileno(), image)
+    elif args.get("reflink"):
+        method = writeImageReflink(image, args["output-file"], args.get("template"))
+        if method != "reflink":
+            print(
+                "warning: %s couldn't be cloned from its template, so it was "
+                "written with %s instead" % (args["output-file"], method),
+                file=sys.stderr,
             )
+    else:
+        with open(args["output-file"], "wb") as fo:
+            fo.write(image)
+
+    return 0
+
+
+def copyFileMetadata(src, fd):
+    # Gives the file open as fd the owner, mode and extended attributes
+    # (including SELinux labels and ACLs) of src, so that replacing src with
+    # it doesn't change who can access it. Fails rather than silently
+    # dropping any of them.
+    st = os.stat(src)
+    if (st.st_uid, st.st_gid) != (os.geteuid(), os.getegid()):
+        os.fchown(fd, st.st_uid, st.st_gid)
+    os.fchmod(fd, st.st_mode & 0o7777)
+    try:
+        names = os.listxattr(src)
+    except OSError as e:
+        if e.errno not in (errno.ENOTSUP, errno.EOPNOTSUPP):
+            raise
+        names = []
+    for name in names:
+        os.setxattr(fd, name, os.getxattr(src, name))
+
+
+def writeFileAtomically(filename, data):
+    d = os.path.dirname(os.path.abspath(filename))
+    fd, tmpName = tempfile.mkstemp(dir=d, prefix=".%s." % os.path.basename(filename))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            try:
+                copyFileMetadata(filename, f.fileno())
+            except FileNotFoundError:
+                pass
+            os.fsync(f.fileno())
+        os.replace(tmpName, filename)
+    except:
+        os.unlink(tmpName)
+        raise
+
+
+def readDataArgument(args):
+    if args.get("hex") is not None:
+        return binascii.unhexlify(args["hex"])
+    if args.get("data_file") is not None:
+        with open(args["data_file"], "rb") as f:
+            return f.read()
+    return b""
+
+
+def cmdSet(args):
+    vendorUUID = lookupUUID(args["vendor"])
+    name = args["name"]
+
+    with VariableStore.open(args["vars-file"], writable=True) as vs:
+        old = vs.findVariables(vendorUUID, name)
+        if old:
+            x = variableToDocument(old[-1])
+        else:
+            x = {"Boot Access": True, "Runtime Access": True}
+
+        if args.get("attributes") is not None:
+            for k in (
+                "Volatile",
+                "Boot Access",
+                "Runtime Access",
+                "Hardware Error Record",
+                "Authenticated Write Access",
+                "Time Based Authenticated Write Access",
+                "Append Write",
+            ):
+                x.pop(k, None)
+            x["Flags"] = args["attributes"]
+            x["Volatile"] = not (args["attributes"] & 0x1)
+
+        x["Data"] = readDataArgument(args)
+        vs.setVariable(
+            AuthenticatedVariable.deserializeFromDocument(str(vendorUUID), name, x)
         )
-        fm.seek(0)
-        fo.write(fm.read())
 
     return 0
 
 
-def cmdGenerateBlank(args):
-    with open(args["output-file"], "wb") as fo:
-        fm = io.BytesIO(b"\xFF" * (528 * 1024))
-        fm.write(FirmwareVolumeHeader.create().serialize())
-        fm.write(VariableStoreHeader.create().serialize())
-
-        fm.seek(0x41000)
-        fm.write(
-            binascii.unhexlify(
-                b"2b29589e687c7d49a0ce6500fd9f1b952caf2c64feffffffe00f000000000000"
+def cmdDelete(args):
+    vendorUUID = lookupUUID(args["vendor"])
+
+    with VariableStore.open(args["vars-file"], writable=True) as vs:
+        if not vs.deleteVariable(vendorUUID, args["name"]):
+            print("variable not found: %s" % args["name"], file=sys.stderr)
+            return 1
+
+    return 0
+
+
+def cmdEnroll(args):
+    payloads = EnrollmentPayloads(lookupUUID(args["owner"]))
+    if args.get("timestamp"):
+        t = datetime.datetime.fromisoformat(args["timestamp"])
+    else:
+        t = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+
+    entries = []
+    for vendorUUID, name, key in (
+        (gEfiImageSecurityDatabaseGuid, "db", "db"),
+        (gEfiImageSecurityDatabaseGuid, "dbx", "dbx"),
+        (gEfiGlobalVariableGuid, "KEK", "kek"),
+        (gEfiGlobalVariableGuid, "PK", "pk"),
+    ):
+        parts = [payloads.load(fn) for fn in args.get(key) or ()]
+        if key == "dbx" and args.get("dbx_hash"):
+            parts.append(
+                payloads.hashes([binascii.unhexlify(h) for h in args["dbx_hash"]])
+            )
+        if not parts:
+            continue
+
+        x = {
+            "Data": b"".join(data for _, data in parts),
+            "Boot Access": True,
+            "Runtime Access": True,
+            "Time Based Authenticated Write Access": True,
+            "Timestamp": t,
+        }
+        for authTime, _ in parts:
+            if authTime and authTime.time:
+                x["Timestamp"] = authTime.time
+        entries.append((vendorUUID, name, x))
+
+    if args.get("secure_boot_enable") is not None:
+        entries.append(
+            (
+                gEfiSecureBootEnableDisableGuid,
+                "SecureBootEnable",
+                {"Data": bytes([args["secure_boot_enable"]]), "Boot Access": True},
             )
         )
-        fm.seek(0)
-        fo.write(fm.read())
 
+    if not entries:
+        print("nothing to enroll", file=sys.stderr)
+        return 1
+
+    files = findVarsFiles(args["path"], args["pattern"])
+    return printFileResults(mapFiles(enrollFile, files, args, entries))
+
+
+def bootFile(filename, ops):
+    modify = any(
+        ops.get(k) for k in ("first", "order", "remove", "remove_class", "add")
+    )
+    rows = []
+    try:
+        with VariableStore.open(filename, writable=modify) as vs:
+            options = {}
+            orderVar = None
+            for av in vs.iterVariables(gEfiGlobalVariableGuid):
+                if av.name == "BootOrder":
+                    orderVar = av
+                elif av.name.startswith("Boot") and LOAD_OPTION_RE.match(av.name):
+                    options[int(av.name[4:], 16)] = av.data
+
+            order = decodeLoadOptionOrder(orderVar.data) if orderVar else []
+            newOrder = list(order)
+
+            def optionClass(n):
+                return loadOptionClass(options[n]) if n in options else "other"
+
+            remove = set(ops.get("remove") or ())
+            for n in options:
+                if optionClass(n) in (ops.get("remove_class") or ()):
+                    remove.add(n)
+            for n in sorted(remove):
+                if n in options:
+                    vs.deleteVariable(gEfiGlobalVariableGuid, "Boot%04X" % n)
+                    del options[n]
+            newOrder = [n for n in newOrder if n not in remove]
+
+            for n, data in ops.get("add") or ():
+                x = {"Data": data, "Boot Access": True, "Runtime Access": True}
+                vs.setVariable(
+                    AuthenticatedVariable.deserializeFromDocument(
+                        str(gEfiGlobalVariableGuid), "Boot%04X" % n, x
+                    )
+                )
+                options[n] = data
+                if n not in newOrder:
+                    newOrder.append(n)
+
+            if ops.get("order"):
+                given = [n for n in ops["order"] if n in newOrder]
+                newOrder = given + [n for n in newOrder if n not in given]
+
+            if ops.get("first"):
+                rank = {c: i for i, c in enumerate(ops["first"])}
+                newOrder.sort(key=lambda n: rank.get(optionClass(n), len(rank)))
+
+            if newOrder != order:
+                if orderVar:
+                    x = variableToDocument(orderVar)
+                else:
+                    x = {"Boot Access": True, "Runtime Access": True}
+                x["Data"] = encodeLoadOptionOrder(newOrder)
+                vs.setVariable(
+                    AuthenticatedVariable.deserializeFromDocument(
+                        str(gEfiGlobalVariableGuid), "BootOrder", x
+                    )
+                )
+
+            if not modify:
+                for i, n in enumerate(newOrder):
+                    if n not in options:
+                        desc, cls, text = "(missing)", "", ""
+                    else:
+                        try:
+                            lo = decodeLoadOption(options[n])
+                            desc, cls, text = lo.description, lo.bootClass, lo.text
+                        except Exception as e:
+                            desc, cls, text = "(cannot decode: %s)" % e, "other", ""
+                    rows.append(
+                        (filename, str(i), "Boot%04X" % n, cls, desc, text)
+                    )
+            else:
+                rows.append(
+                    (
+                        filename,
+                        "BootOrder",
+                        ",".join("%04X" % n for n in newOrder),
+                    )
+                )
+    except Exception as e:
+        return filename, rows, str(e)
+
+    return filename, rows, None
+
+
+def cmdBoot(args):
+    add = []
+    for a in args.get("add") or ():
+        n, _, h = a.partition("=")
+        n, data = int(n, 16), binascii.unhexlify(h)
+        try:
+            decodeLoadOption(data)
+        except Exception as e:
+            print("bad load option for Boot%04X: %s" % (n, e), file=sys.stderr)
+            return 1
+        add.append((n, data))
+
+    ops = dict(
+        first=args.get("first"),
+        order=[int(n, 16) for n in args["order"].split(",")]
+        if args.get("order")
+        else None,
+        remove=[int(n, 16) for n in args.get("remove") or ()],
+        remove_class=args.get("remove_class"),
+        add=add,
+    )
+
+    files = findVarsFiles(args["path"], args["pattern"])
+    return printFileResults(mapFiles(bootFile, files, args, ops))
+
+
+def reclaimFile(filename, dryRun=False):
+    # Reports the bytes reclaimed and the bytes of variable records left in
+    # use, measured as verify does from the start of the variable region.
+    rows = []
+    try:
+        with VariableStore.open(filename) as vs:
+            used = vs.usedLimit
+            image, newUsed = vs.reclaim()
+            changed = used != newUsed or vs.buf[:newUsed] != image[:newUsed]
+            rows.append((filename, str(used - newUsed), str(newUsed - vs.varOffset)))
+
+        if changed and not dryRun:
+            writeFileAtomically(filename, image)
+    except Exception as e:
+        return filename, rows, str(e)
+
+    return filename, rows, None
+
+
+def cmdReclaim(args):
+    files = findVarsFiles(args["path"], args["pattern"])
+    return printFileResults(
+        mapFiles(reclaimFile, files, args, bool(args.get("dry_run")))
+    )
+
+
+def replayFaultTolerantWrite(image, vs):
+    # Finishes or abandons an interrupted fault tolerant write as EDK2 does
+    # on boot, then resets the working block. A write whose spare copy was
+    # completed is replayed by copying the spare area over its target blocks
+    # (except the working block itself, which EDK2 handles separately);
+    # otherwise its target was never touched and it is dropped. Returns a
+    # list of (offset, action).
+    actions = []
+    geometry = FlashGeometry.fromStore(vs)
+    base = vs.offset
+    ftwOffset = base + geometry.ftwOffset
+    ftwEnd = base + geometry.spareOffset
+    if ftwOffset + FTW_WORKING_BLOCK_HEADER_STRUCT.size > ftwEnd or not (
+        ftwWorkingBlockValid(image, ftwOffset)
+    ):
+        geometry = FlashGeometry(
+            geometry.blockSize,
+            geometry.numBlocks,
+            geometry.liveSize,
+            geometry.fvLen - geometry.liveSize - 0x2000,
+        )
+        ftwOffset = base + geometry.ftwOffset
+        ftwEnd = base + geometry.spareOffset
+        actions.append((ftwOffset, "rewrote invalid working block header"))
+    else:
+        try:
+            last = ftwLastWrite(image, ftwOffset, ftwEnd)
+        except Exception as e:
+            last = None
+            actions.append((ftwOffset, "discarded write queue: %s" % e))
+        if last and last[1] & FTW_WRITE_COMPLETE and not last[2]:
+            actions.append((last[0], "dropped pending write with no records"))
+        elif last and last[1] & FTW_WRITE_COMPLETE:
+            for recOffset, state, lba, _, length in last[2]:
+                if not state & FTW_DESTINATION_COMPLETE:
+                    continue
+                if state & FTW_SPARE_COMPLETE:
+                    actions.append(
+                        (recOffset, "rolled back write of %d bytes" % length)
+                    )
+                    continue
+                target = base + lba * geometry.blockSize
+                n = min(geometry.spareSize, base + geometry.fvLen - target)
+                spare = bytes(image[ftwEnd : ftwEnd + n])
+                for start, stop in ((target, ftwOffset), (ftwEnd, target + n)):
+                    start, stop = max(start, target), min(stop, target + n)
+                    if start < stop:
+                        image[start:stop] = spare[start - target : stop - target]
+                actions.append(
+                    (recOffset, "replayed write of %d bytes to 0x%x" % (length, target))
+                )
+        if not actions:
+            return actions
+
+    b = ftwWorkingBlockHeader(ftwEnd - ftwOffset)
+    image[ftwOffset:ftwEnd] = b + b"\xFF" * (ftwEnd - ftwOffset - len(b))
+    return actions
+
+
+def recoverImage(image):
+    # Brings the store in the bytearray image back to a clean state after an
+    # interrupted update: replays or rolls back a pending fault tolerant
+    # write, repairs the variable store header state, and reclaims the store
+    # if it holds incompletely written or corrupt records. Returns a list of
+    # (offset, action); the list is empty if the store was clean.
+    vs = VariableStore(image, strict=False)
+    try:
+        actions = replayFaultTolerantWrite(image, vs)
+    finally:
+        vs.close()
+
+    vs = VariableStore(image, strict=False)
+    try:
+        if vs.vsh.fmt != 0x5A or vs.vsh.state != 0xFE:
+            image[vs.vshOffset + 20] = 0x5A
+            image[vs.vshOffset + 21] = 0xFE
+            actions.append(
+                (
+                    vs.vshOffset,
+                    "marked store formatted and healthy (was 0x%02x/0x%02x)"
+                    % (vs.vsh.fmt, vs.vsh.state),
+                )
+            )
+
+        torn = []
+        for av in vs.variables(resync=True):
+            state = av.state ^ 0xFF
+            if not state & VAR_STATE_ADDED:
+                torn.append((av.offset, "dropped partly written variable"))
+            elif state & VAR_STATE_IN_DELETED_TRANSITION and not av.isDeleted:
+                torn.append((av.offset, "resolved variable in deleted transition"))
+        for offset, n in vs.skipped:
+            torn.append((offset, "skipped %d bytes of corrupt records" % n))
+
+        if torn:
+            reclaimed, _ = vs.reclaim(resync=True)
+            actions.extend(sorted(torn))
+    finally:
+        vs.close()
+
+    if torn:
+        image[:] = reclaimed
+    return actions
+
+
+def recoverFile(filename, dryRun=False):
+    rows = []
+    try:
+        with open(filename, "rb") as f:
+            image = bytearray(f.read())
+        actions = recoverImage(image)
+        if actions and not dryRun:
+            writeFileAtomically(filename, image)
+        for offset, action in actions:
+            rows.append((filename, "0x%x" % offset, action))
+    except Exception as e:
+        return filename, rows, str(e)
+
+    return filename, rows, None
+
+
+def cmdRecover(args):
+    files = findVarsFiles(args["path"], args["pattern"])
+    return printFileResults(
+        mapFiles(recoverFile, files, args, bool(args.get("dry_run")))
+    )
+
+
+def findVarsFiles(paths, pattern="*VARS*.fd"):
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for fn in sorted(files):
+                if fnmatch.fnmatch(fn, pattern):
+                    yield os.path.join(root, fn)
+
+
+def scanFile(filename, criteria):
+    rows = []
+    try:
+        with VariableStore.open(filename) as vs:
+            for av in vs.iterVariables(
+                criteria.get("vendor") or None,
+                criteria.get("name"),
+                criteria.get("deleted"),
+            ):
+                if criteria.get("flags") and (
+                    av.flags & criteria["flags"] != criteria["flags"]
+                ):
+                    continue
+                if (
+                    criteria.get("data_len") is not None
+                    and av.dataLen != criteria["data_len"]
+                ):
+                    continue
+                if criteria.get("data") is not None and av.data != criteria["data"]:
+                    continue
+
+                rows.append(
+                    (
+                        filename,
+                        resolveUUID(av.vendorUUID),
+                        av.name,
+                        "0x%x" % av.flags,
+                        str(av.dataLen),
+                        binascii.hexlify(av.data).decode("ascii"),
+                    )
+                )
+    except Exception as e:
+        return filename, rows, str(e)
+
+    return filename, rows, None
+
+
+def firstNotErased(buf, start, end):
+    # Returns the offset of the first byte in buf[start:end] which isn't 0xFF,
+    # or None. The scan is done by bytes.lstrip() rather than a Python loop.
+    rest = len(bytes(buf[start:end]).lstrip(b"\xFF"))
+    return end - rest if rest else None
+
+
+def verifyImage(buf):
+    # Checks the structure of the variable store in buf without trusting any
+    # of it, returning a result with a list of errors (which make the store
+    # unusable or indicate corruption) and warnings (states an interrupted
+    # update leaves behind, which EDK2 recovers from).
+    result = dict(OK=True, Errors=[], Warnings=[])
+
+    def error(offset, msg):
+        result["OK"] = False
+        result["Errors"].append(dict(Offset=offset, Error=msg))
+
+    def warning(offset, msg):
+        result["Warnings"].append(dict(Offset=offset, Warning=msg))
+
+    buf = memoryview(buf)
+    try:
+        offset = findVariableStore(buf)
+        fvh = FirmwareVolumeHeader.deserializeFrom(buf, offset)
+    except Exception as e:
+        error(0, str(e))
+        return result
+    result["Offset"] = offset
+
+    end = offset + fvh.fvLen
+    if end > len(buf):
+        error(offset, "firmware volume length 0x%x exceeds file size" % fvh.fvLen)
+        end = len(buf)
+    if fvh.hdrLen != FV_HEADER_STRUCT.size + FV_BLOCK_MAP_ENTRY_STRUCT.size * (
+        len(fvh.blkInfo) + 1
+    ):
+        error(offset, "header length %d does not match block map" % fvh.hdrLen)
+    if sum(n * L for n, L in fvh.blkInfo) != fvh.fvLen:
+        error(offset, "block map does not cover the firmware volume")
+    if fvh.hdrLen % 2 or offset + fvh.hdrLen > end:
+        error(offset, "bad header length %d" % fvh.hdrLen)
+        return result
+    words = struct.unpack_from("<%dH" % (fvh.hdrLen // 2), buf, offset)
+    if sum(words) & 0xFFFF:
+        error(offset, "bad firmware volume header checksum 0x%04x" % fvh.checksum)
+    if fvh.rev != 2:
+        warning(offset, "unexpected firmware volume revision %d" % fvh.rev)
+
+    vshOffset = offset + fvh.hdrLen
+    hdrUUID, vsLen, fmt, state, _, _ = VARIABLE_STORE_HEADER_STRUCT.unpack_from(
+        buf, vshOffset
+    )
+    if hdrUUID != gEfiAuthenticatedVariableGuid.bytes:
+        error(vshOffset, "unexpected variable store header UUID")
+        return result
+    if fmt != 0x5A:
+        error(vshOffset, "variable store format is 0x%02x, not 0x5a" % fmt)
+    if state != 0xFE:
+        error(vshOffset, "variable store state is 0x%02x, not 0xfe" % state)
+    varLimit = vshOffset + vsLen
+    if varLimit > end:
+        error(vshOffset, "variable store length 0x%x exceeds firmware volume" % vsLen)
+        varLimit = end
+
+    hdrSize = AUTHENTICATED_VARIABLE_HEADER_STRUCT.size
+    varStart = vshOffset + VARIABLE_STORE_HEADER_STRUCT.size
+    varOffset = varStart
+    numVars = numDeleted = 0
+    while varOffset + hdrSize <= varLimit:
+        magic, state = struct.unpack_from("<HB", buf, varOffset)
+        if magic == 0xFFFF:
+            break
+        if magic != 0x55AA:
+            error(varOffset, "bad variable header magic 0x%04x" % magic)
+            break
+        nameLen, dataLen = struct.unpack_from("<II", buf, varOffset + 36)
+        recEnd = varOffset + hdrSize + nameLen + dataLen
+        if recEnd > varLimit:
+            error(varOffset, "variable extends past end of store")
+            break
+        nameEnd = varOffset + hdrSize + nameLen
+        if nameLen < 2 or nameLen % 2 or buf[nameEnd - 2 : nameEnd] != b"\0\0":
+            error(varOffset, "bad variable name length %d" % nameLen)
+        setBits = state ^ 0xFF
+        if not setBits & VAR_STATE_HEADER_VALID:
+            error(varOffset, "variable header not marked valid (state 0x%02x)" % state)
+        elif not setBits & VAR_STATE_ADDED:
+            warning(varOffset, "variable only partly written (state 0x%02x)" % state)
+        elif (
+            setBits & VAR_STATE_IN_DELETED_TRANSITION
+            and not setBits & VAR_STATE_DELETED
+        ):
+            warning(varOffset, "variable left in deleted transition")
+        numVars += 1
+        if setBits & VAR_STATE_DELETED:
+            numDeleted += 1
+        # Records are aligned relative to the start of the firmware volume.
+        alignedEnd = recEnd + (-(recEnd - offset) & 3)
+        if firstNotErased(buf, recEnd, min(alignedEnd, varLimit)) is not None:
+            error(recEnd, "padding after variable is not erased")
+        varOffset = alignedEnd
+
+    result["Variables"] = numVars
+    result["Deleted"] = numDeleted
+    result["Used"] = varOffset - varStart
+    result["Free"] = max(varLimit - varOffset, 0)
+    bad = firstNotErased(buf, varOffset, varLimit)
+    if bad is not None:
+        error(bad, "free space is not erased")
+
+    # The working block is found the same way recovery finds it, so that
+    # layouts other than OVMF's are checked in the right place.
+    try:
+        vs = VariableStore(buf, offset, strict=False)
+        try:
+            geometry = FlashGeometry.fromStore(vs)
+        finally:
+            vs.close()
+    except Exception as e:
+        error(offset, "cannot determine flash layout: %s" % e)
+        return result
+    ftwOffset = offset + geometry.ftwOffset
+    ftwSize = FTW_WORKING_BLOCK_HEADER_STRUCT.size
+    if ftwOffset + ftwSize > end:
+        error(ftwOffset, "no room for the fault tolerant write working block")
+        return result
+    sig, crc, state, _, writeQueueSize = FTW_WORKING_BLOCK_HEADER_STRUCT.unpack_from(
+        buf, ftwOffset
+    )
+    if sig != gEdkiiWorkingBlockSignatureGuid.bytes:
+        error(ftwOffset, "missing fault tolerant write working block signature")
+        return result
+    if ftwHeaderCrc(buf[ftwOffset : ftwOffset + ftwSize]) != crc:
+        error(ftwOffset, "bad fault tolerant write working block CRC")
+    if (
+        state & (FTW_WORKING_BLOCK_VALID | FTW_WORKING_BLOCK_INVALID)
+        != FTW_WORKING_BLOCK_INVALID
+    ):
+        error(ftwOffset, "fault tolerant write working block not valid")
+    if ftwOffset + ftwSize + writeQueueSize > end:
+        error(ftwOffset, "fault tolerant write queue extends past firmware volume")
+        return result
+    try:
+        last = ftwLastWrite(buf, ftwOffset, ftwOffset + ftwSize + writeQueueSize)
+    except Exception as e:
+        error(ftwOffset, str(e))
+    else:
+        if last and last[1] & FTW_WRITE_COMPLETE:
+            warning(last[0], "fault tolerant write pending")
+
+    return result
+
+
+def cmdVerify(args):
+    rc = 0
+    for filename in findVarsFiles(args["path"], args["pattern"]):
+        try:
+            with open(filename, "rb") as f:
+                result = verifyImage(f.read())
+        except OSError as e:
+            result = dict(OK=False, Errors=[dict(Offset=0, Error=str(e))])
+        result = dict(File=filename, **result)
+        if not result["OK"]:
+            rc = 1
+        sys.stdout.write(json.dumps(result) + "\n")
+    return rc
+
+
+def cmdScan(args):
+    criteria = dict(
+        vendor=lookupUUID(args["vendor"]) if args.get("vendor") else None,
+        name=args.get("name"),
+        flags=args.get("flags"),
+        data_len=args.get("data_len"),
+        data=binascii.unhexlify(args["data"]) if args.get("data") else None,
+        deleted=args.get("deleted"),
+    )
+
+    files = findVarsFiles(args["path"], args["pattern"])
+    return printFileResults(mapFiles(scanFile, files, args, criteria))
+
+
+def mapFiles(fn, files, args, *extra):
+    # Calls fn(filename, *extra) for each file in a process pool, yielding
+    # the results in order.
+    if args.get("jobs") == 1:
+        for filename in files:
+            yield fn(filename, *extra)
+        return
+
+    # Imported here rather than at the top, as it adds noticeably to the
+    # startup time of every command.
+    import concurrent.futures
+
+    with concurrent.futures.ProcessPoolExecutor(
+        args.get("jobs"),
+        initializer=setGuidDatabases,
+        initargs=(list(guidDatabasePaths),),
+    ) as pool:
+        yield from pool.map(
+            fn,
+            files,
+            *(itertools.repeat(x) for x in extra),
+            chunksize=args.get("chunk_size") or 64,
+        )
+
+
+def printFileResults(results):
+    rc = 0
+    for filename, rows, err in results:
+        if err:
+            print("%s: %s" % (filename, err), file=sys.stderr)
+            rc = 1
+        for row in rows:
+            sys.stdout.write("\t".join(row) + "\n")
+    return rc
+
+
+def checkSignatureDatabases(filename, names, digests):
+    rows = []
+    try:
+        with VariableStore.open(filename) as vs:
+            for av in vs.iterVariables():
+                if (av.vendorUUID, av.name) not in SIGNATURE_DATABASE_VARIABLES:
+                    continue
+                if names and av.name not in names:
+                    continue
+
+                sdb = SignatureDatabase.deserialize(av.data)
+                if digests is None:
+                    for sl in sdb.lists:
+                        for owner, data in sl.signatures:
+                            rows.append(
+                                (
+                                    filename,
+                                    av.name,
+                                    sl.typeName,
+                                    resolveUUID(owner),
+                                    binascii.hexlify(data).decode("ascii"),
+                                )
+                            )
+                    continue
+
+                for digest in sorted(sdb.query(digests)):
+                    for sigType, owner, _ in sdb.lookup(digest):
+                        rows.append(
+                            (
+                                filename,
+                                av.name,
+                                SIGNATURE_TYPES.get(sigType, str(sigType)),
+                                resolveUUID(owner),
+                                binascii.hexlify(digest).decode("ascii"),
+                            )
+                        )
+    except Exception as e:
+        return filename, rows, str(e)
+
+    return filename, rows, None
+
+
+def cmdSignatures(args):
+    digests = None
+    if args.get("check") or args.get("check_file"):
+        digests = set(binascii.unhexlify(h) for h in args.get("check") or ())
+        if args.get("check_file"):
+            with open(args["check_file"], "r") as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith("#"):
+                        digests.add(binascii.unhexlify(line.split()[0]))
+
+    files = findVarsFiles(args["path"], args["pattern"])
+    return printFileResults(
+        mapFiles(checkSignatureDatabases, files, args, args.get("var"), digests)
+    )
+
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    ingested TEXT NOT NULL,
+    boot_first TEXT,
+    boot_first_class TEXT
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    hash TEXT PRIMARY KEY,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS variables (
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    vendor TEXT NOT NULL,
+    vendor_uuid TEXT NOT NULL,
+    name TEXT NOT NULL,
+    flags INTEGER NOT NULL,
+    monotonic_count INTEGER NOT NULL,
+    timestamp TEXT,
+    data_len INTEGER NOT NULL,
+    data_hash TEXT NOT NULL REFERENCES blobs(hash)
+);
+CREATE INDEX IF NOT EXISTS variables_by_file ON variables(file_id);
+CREATE INDEX IF NOT EXISTS variables_by_name ON variables(name, vendor_uuid);
+CREATE INDEX IF NOT EXISTS variables_by_data ON variables(data_hash);
+"""
+
+
+def openCatalog(filename):
+    import sqlite3
+
+    db = sqlite3.connect(filename)
+    db.execute("PRAGMA foreign_keys = ON")
+    db.execute("PRAGMA journal_mode = WAL")
+    db.executescript(CATALOG_SCHEMA)
+
+    # Catalogs created before the boot order columns were added get them
+    # here, and all their files are reingested on the next run to fill them.
+    columns = set(r[1] for r in db.execute("PRAGMA table_info(files)"))
+    if "boot_first" not in columns:
+        with db:
+            db.execute("ALTER TABLE files ADD COLUMN boot_first TEXT")
+            db.execute("ALTER TABLE files ADD COLUMN boot_first_class TEXT")
+            db.execute("UPDATE files SET mtime_ns = -1, hash = ''")
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS files_by_boot_first "
+        "ON files(boot_first_class, boot_first)"
+    )
+    return db
+
+
+def ingestFile(db, filename):
+    # Returns True if the file was (re)ingested, False if it was unchanged.
+    path = os.path.abspath(filename)
+    st = os.stat(path)
+    row = db.execute(
+        "SELECT id, size, mtime_ns, hash FROM files WHERE path = ?", (path,)
+    ).fetchone()
+    if row and row[1] == st.st_size and row[2] == st.st_mtime_ns:
+        return False
+
+    with open(path, "rb") as f:
+        b = f.read()
+
+    h = hashlib.sha256(b).hexdigest()
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat(" ")
+    with db:
+        if row and row[3] == h:
+            db.execute(
+                "UPDATE files SET size = ?, mtime_ns = ? WHERE id = ?",
+                (st.st_size, st.st_mtime_ns, row[0]),
+            )
+            return False
+
+        vs = VariableStore(b)
+        if row:
+            fileID = row[0]
+            db.execute("DELETE FROM variables WHERE file_id = ?", (fileID,))
+            db.execute(
+                "UPDATE files SET size = ?, mtime_ns = ?, hash = ?, ingested = ? "
+                "WHERE id = ?",
+                (st.st_size, st.st_mtime_ns, h, now, fileID),
+            )
+        else:
+            fileID = db.execute(
+                "INSERT INTO files (path, size, mtime_ns, hash, ingested) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (path, st.st_size, st.st_mtime_ns, h, now),
+            ).lastrowid
+
+        bootOrder = None
+        bootOptions = {}
+        for av in vs.iterVariables():
+            x = variableToDocument(av)
+            dataHash = hashlib.sha256(x["Data"]).hexdigest()
+            if av.vendorUUID == gEfiGlobalVariableGuid:
+                if av.name == "BootOrder":
+                    bootOrder = x["Data"]
+                elif av.name.startswith("Boot") and LOAD_OPTION_RE.match(av.name):
+                    bootOptions[av.name] = x["Data"]
+            t = x.get("Timestamp")
+            if t:
+                t = t.astimezone(datetime.timezone.utc).isoformat(" ")
+
+            db.execute(
+                "INSERT OR IGNORE INTO blobs (hash, data) VALUES (?, ?)",
+                (dataHash, x["Data"]),
+            )
+            db.execute(
+                "INSERT INTO variables (file_id, vendor, vendor_uuid, name, flags, "
+                "monotonic_count, timestamp, data_len, data_hash) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    fileID,
+                    resolveUUID(av.vendorUUID),
+                    str(av.vendorUUID),
+                    av.name,
+                    av.flags,
+                    x.get("Monotonic Count", 0),
+                    t,
+                    av.dataLen,
+                    dataHash,
+                ),
+            )
+
+        # The first entry of BootOrder and its class are kept with the file
+        # so that boot order queries can use an index.
+        bootFirst = bootFirstClass = None
+        order = decodeLoadOptionOrder(bootOrder) if bootOrder else []
+        if order:
+            bootFirst = "Boot%04X" % order[0]
+            if bootFirst in bootOptions:
+                bootFirstClass = loadOptionClass(bootOptions[bootFirst])
+        db.execute(
+            "UPDATE files SET boot_first = ?, boot_first_class = ? WHERE id = ?",
+            (bootFirst, bootFirstClass, fileID),
+        )
+
+        vs.close()
+
+    return True
+
+
+def cmdCatalogIngest(args):
+    db = openCatalog(args["database"])
+    rc = 0
+    ingested = skipped = 0
+    for filename in findVarsFiles(args["path"], args["pattern"]):
+        try:
+            if ingestFile(db, filename):
+                ingested += 1
+            else:
+                skipped += 1
+        except Exception as e:
+            print("%s: %s" % (filename, e), file=sys.stderr)
+            rc = 1
+
+    pruned = 0
+    if args.get("prune"):
+        with db:
+            for fileID, path in db.execute("SELECT id, path FROM files").fetchall():
+                if not os.path.exists(path):
+                    db.execute("DELETE FROM files WHERE id = ?", (fileID,))
+                    pruned += 1
+
+    print(
+        "%s files ingested, %s unchanged, %s pruned" % (ingested, skipped, pruned),
+        file=sys.stderr,
+    )
+    db.close()
+    return rc
+
+
+def cmdCatalogQuery(args):
+    db = openCatalog(args["database"])
+    for row in db.execute(args["sql"], args["param"]):
+        sys.stdout.write(
+            "\t".join(
+                binascii.hexlify(v).decode("ascii") if isinstance(v, bytes) else str(v)
+                for v in row
+            )
+            + "\n"
+        )
+    db.close()
     return 0
 
 
+class StoreCache(object):
+    def __init__(self, maxEntries=256):
+        self.maxEntries = maxEntries
+        self._entries = collections.OrderedDict()
+        self._keysByPath = {}
+
+    def get(self, filename):
+        st = os.stat(filename)
+        k = (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+        e = self._entries.get(k)
+        if e is not None:
+            self._entries.move_to_end(k)
+            return e[1:]
+
+        oldKey = self._keysByPath.pop(filename, None)
+        if oldKey is not None:
+            self._entries.pop(oldKey, None)
+
+        with open(filename, "rb") as f:
+            vs = VariableStore(f.read())
+
+        e = (filename, vs, list(vs.iterVariables()))
+        self._entries[k] = e
+        self._keysByPath[filename] = k
+        while len(self._entries) > self.maxEntries:
+            oldKey, (oldFilename, _, _) = self._entries.popitem(last=False)
+            if self._keysByPath.get(oldFilename) == oldKey:
+                del self._keysByPath[oldFilename]
+
+        return e[1:]
+
+    def handleRequest(self, req):
+        op = req.get("op")
+        vs, avs = self.get(req["file"])
+        if op == "list":
+            return [
+                dict(
+                    vendor=resolveUUID(av.vendorUUID),
+                    name=av.name,
+                    flags=av.flags,
+                    dataLen=av.dataLen,
+                )
+                for av in avs
+            ]
+        elif op == "get":
+            vendorUUID = lookupUUID(req["vendor"])
+            for av in avs:
+                if av.vendorUUID == vendorUUID and av.name == req["name"]:
+                    x = variableToDocument(av)
+                    x["Vendor"] = resolveUUID(av.vendorUUID)
+                    x["Name"] = av.name
+                    return x
+            raise Exception("variable not found: %s" % req["name"])
+        elif op == "export":
+            docVars = {}
+            for av in avs:
+                k = resolveUUID(av.vendorUUID)
+                docVars.setdefault(k, {})[av.name] = variableToDocument(av)
+            return dict(Variables=docVars)
+        else:
+            raise Exception("unknown operation: %r" % op)
+
+    async def handleConnection(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    res = dict(ok=True, result=self.handleRequest(json.loads(line)))
+                except Exception as e:
+                    res = dict(ok=False, error=str(e))
+                writer.write(json.dumps(res, default=jsonDefault).encode() + b"\n")
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+def cmdServe(args):
+    import asyncio
+
+    # A socket left behind by a previous daemon is replaced, but anything
+    # else at that path is left alone.
+    try:
+        st = os.lstat(args["socket"])
+    except FileNotFoundError:
+        pass
+    else:
+        if not stat.S_ISSOCK(st.st_mode):
+            print("%s exists and is not a socket" % args["socket"], file=sys.stderr)
+            return 1
+        os.unlink(args["socket"])
+
+    cache = StoreCache(args["cache_size"])
+
+    async def serve():
+        server = await asyncio.start_unix_server(
+            cache.handleConnection, args["socket"]
+        )
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def daemonRequest(socketPath, req):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(socketPath)
+        s.sendall(json.dumps(req).encode() + b"\n")
+        with s.makefile("rb") as f:
+            res = json.loads(f.readline())
+
+    if not res["ok"]:
+        raise Exception(res["error"])
+    return res["result"]
+
+
+def cmdClient(args):
+    req = dict(op=args["op"], file=os.path.abspath(args["vars-file"]))
+    if args["op"] == "get":
+        if not args.get("vendor") or not args.get("name"):
+            print("get requires a vendor and a name", file=sys.stderr)
+            return 1
+        req["vendor"] = args["vendor"]
+        req["name"] = args["name"]
+
+    try:
+        res = daemonRequest(args["socket"], req)
+    except Exception as e:
+        print(str(e), file=sys.stderr)
+        return 1
+
+    print(json.dumps(res, indent=2))
+    return 0
+
+
+def cmdGenerateBlank(args):
+    return writeImage(generateBlank(geometryArgument(args)), args)
+
+
+def geometryArgument(args):
+    if args.get("geometry"):
+        return FlashGeometry.fromArgument(args["geometry"])
+    return None
+
+
+def addPathArguments(ap, verb, jobs=True):
+    # The files and directories a batch command works on, and (for those
+    # which process them in parallel) the number of worker processes.
+    ap.add_argument(
+        "path", nargs="+", help="OVMF_VARS.fd files or directories to %s" % verb
+    )
+    ap.add_argument(
+        "--pattern",
+        default="*VARS*.fd",
+        help="filename pattern to match in directories (default: %(default)s)",
+    )
+    if jobs:
+        ap.add_argument(
+            "--jobs",
+            "-j",
+            type=int,
+            help="number of worker processes (default: CPUs)",
+        )
+
+
+def addOutputArguments(ap):
+    ap.add_argument(
+        "--geometry",
+        "-g",
+        help="flash layout to generate: 4m (528 KiB, the default), 2m (128 KiB) "
+        "or the path of an existing OVMF_VARS.fd to copy the layout of",
+    )
+    ap.add_argument(
+        "output-file",
+        help="Filename to write OVMF_VARS.fd to, or - for standard output, --fd "
+        "or --memfd",
+    )
+    ap.add_argument("--fd", type=int, help="write to this file descriptor instead")
+    ap.add_argument(
+        "--memfd",
+        action="store_true",
+        help="write to a memfd which is passed to the command given with --exec",
+    )
+    ap.add_argument(
+        "--seal", action="store_true", help="seal the memfd against modification"
+    )
+    ap.add_argument(
+        "--reflink",
+        action="store_true",
+        help="clone the output file from a cached blank template and only write "
+        "the blocks which differ from it",
+    )
+    ap.add_argument(
+        "--template",
+        help="template file to clone with --reflink (created if missing)",
+    )
+    ap.add_argument(
+        "--exec",
+        nargs=argparse.REMAINDER,
+        help="command to run with --memfd; {fd} in arguments is replaced with "
+        "the descriptor number",
+    )
+
+
 def run():
     ap = argparse.ArgumentParser()
+    ap.add_argument(
+        "--guid-db",
+        action="append",
+        help="file of GUID names (EDK2 .dec style or GUID/name pairs) to use "
+        "in addition to the built-in ones; may be repeated",
+    )
     subap = ap.add_subparsers(help="subcommands")
     apDump = subap.add_parser(
         "dump", help="Dump information in a OVMF_VARS.fd file in human-readable form"
@@ -722,6 +3541,40 @@ def run():
     apGenerateBlank = subap.add_parser(
         "generate-blank", help="Generate an empty OVMF_VARS.fd file"
     )
+    apReclaim = subap.add_parser(
+        "reclaim", help="Compact an OVMF_VARS.fd by dropping deleted variables"
+    )
+    apRecover = subap.add_parser(
+        "recover",
+        help="Repair OVMF_VARS.fd files left behind by an interrupted update",
+    )
+    apVerify = subap.add_parser(
+        "verify", help="Check the structure of OVMF_VARS.fd files"
+    )
+    apScan = subap.add_parser(
+        "scan", help="Search directories of OVMF_VARS.fd files for variables"
+    )
+    apCatalog = subap.add_parser(
+        "catalog", help="Maintain and query an SQLite catalog of variables"
+    )
+    apServe = subap.add_parser(
+        "serve", help="Answer queries about OVMF_VARS.fd files over a Unix socket"
+    )
+    apClient = subap.add_parser("client", help="Send a query to an ovmfvartool daemon")
+    apSignatures = subap.add_parser(
+        "signatures",
+        help="List or look up entries in the Secure Boot signature databases",
+    )
+    apEnroll = subap.add_parser(
+        "enroll", help="Enroll Secure Boot keys into OVMF_VARS.fd files in place"
+    )
+    apBoot = subap.add_parser(
+        "boot", help="Show or rewrite the boot order of OVMF_VARS.fd files"
+    )
+    apSet = subap.add_parser("set", help="Set a variable in an OVMF_VARS.fd in place")
+    apDelete = subap.add_parser(
+        "delete", help="Delete a variable from an OVMF_VARS.fd in place"
+    )
 
     apDump.add_argument("input-file", help="OVMF_VARS.fd file to dump")
     apDump.add_argument(
@@ -729,23 +3582,264 @@ def run():
     )
     apDump.set_defaults(func=cmdDump)
 
-    apExport.add_argument("input-file", help="OVMF_VARS.fd file to dump")
+    apExport.add_argument(
+        "input-file",
+        nargs="+",
+        help="OVMF_VARS.fd file to dump (with --ndjson, any number of files or "
+        "directories)",
+    )
+    apExport.add_argument(
+        "--format",
+        "-f",
+        choices=("yaml", "json", "msgpack"),
+        default="yaml",
+        help="output format (default: %(default)s)",
+    )
+    apExport.add_argument(
+        "--ndjson",
+        action="store_true",
+        help="write one JSON object per line for each file and variable as the "
+        "files are read",
+    )
+    apExport.add_argument(
+        "--data-encoding",
+        choices=("base64", "hex", "sha256"),
+        default="base64",
+        help="how to write variable data with --ndjson; sha256 writes only a "
+        "hash (default: %(default)s)",
+    )
+    apExport.add_argument(
+        "--blob-dir",
+        help="move variable data larger than --blob-threshold into files in "
+        "this directory named by their SHA-256 hash, referring to them by hash",
+    )
+    apExport.add_argument(
+        "--blob-threshold",
+        type=int,
+        default=256,
+        help="data size in bytes above which --blob-dir is used (default: "
+        "%(default)s)",
+    )
+    apExport.add_argument(
+        "--pattern",
+        default="*VARS*.fd",
+        help="filename pattern to match in directories with --ndjson (default: "
+        "%(default)s)",
+    )
     apExport.set_defaults(func=cmdExport)
 
     apCompile.add_argument("input-file", help="YAML file to compile")
-    apCompile.add_argument("output-file", help="Filename to write OVMF_VARS.fd to")
+    addOutputArguments(apCompile)
+    apCompile.add_argument(
+        "--format",
+        "-f",
+        choices=("yaml", "json", "msgpack"),
+        help="input format (default: guessed from the file extension, else yaml)",
+    )
+    apCompile.add_argument(
+        "--base",
+        help="OVMF_VARS.fd to start from, treating the input file as an overlay",
+    )
+    apCompile.add_argument(
+        "--blob-dir",
+        help="directory to resolve data blob references from, as written by "
+        "export --blob-dir",
+    )
     apCompile.set_defaults(func=cmdCompile)
 
-    apGenerateBlank.add_argument(
-        "output-file", help="Filename to write OVMF_VARS.fd to"
-    )
+    addOutputArguments(apGenerateBlank)
     apGenerateBlank.set_defaults(func=cmdGenerateBlank)
 
+    apSet.add_argument("vars-file", help="OVMF_VARS.fd file to modify")
+    apSet.add_argument("vendor", help="vendor GUID (name or UUID) of the variable")
+    apSet.add_argument("name", help="name of the variable")
+    apSetData = apSet.add_mutually_exclusive_group(required=True)
+    apSetData.add_argument("--hex", help="variable data as a hex string")
+    apSetData.add_argument("--data-file", help="file to read variable data from")
+    apSet.add_argument(
+        "--attributes",
+        type=lambda x: int(x, 0),
+        help="attribute flags (default: keep existing, or NV+BS+RT for new variables)",
+    )
+    apSet.set_defaults(func=cmdSet)
+
+    apDelete.add_argument("vars-file", help="OVMF_VARS.fd file to modify")
+    apDelete.add_argument("vendor", help="vendor GUID (name or UUID) of the variable")
+    apDelete.add_argument("name", help="name of the variable")
+    apDelete.set_defaults(func=cmdDelete)
+
+    addPathArguments(apEnroll, "modify")
+    for key, name in (("pk", "PK"), ("kek", "KEK"), ("db", "db"), ("dbx", "dbx")):
+        apEnroll.add_argument(
+            "--" + key,
+            action="append",
+            help="certificate (DER or PEM), EFI_SIGNATURE_LIST or signed .auth "
+            "file to enroll in %s; may be repeated" % name,
+        )
+    apEnroll.add_argument(
+        "--dbx-hash",
+        action="append",
+        help="SHA-256 hash (hex) to enroll in dbx; may be repeated",
+    )
+    apEnroll.add_argument(
+        "--owner",
+        default=str(uuid.UUID(int=0)),
+        help="signature owner GUID for certificates and hashes",
+    )
+    apEnroll.add_argument(
+        "--timestamp",
+        help="timestamp for the variables (ISO 8601; default: now, or the time "
+        "in a .auth file)",
+    )
+    apEnroll.add_argument(
+        "--secure-boot-enable",
+        type=int,
+        choices=(0, 1),
+        help="also set SecureBootEnable to this value",
+    )
+    apEnroll.set_defaults(func=cmdEnroll)
+
+    bootClasses = ("http", "pxe", "cdrom", "disk", "app", "other")
+    addPathArguments(apBoot, "process")
+    apBoot.add_argument(
+        "--first",
+        action="append",
+        choices=bootClasses,
+        help="move boot options of this kind to the front of BootOrder; may be "
+        "repeated to give an order of preference",
+    )
+    apBoot.add_argument(
+        "--order",
+        help="comma-separated hex option numbers to put at the front of BootOrder",
+    )
+    apBoot.add_argument(
+        "--remove",
+        action="append",
+        help="delete this boot option (hex number); may be repeated",
+    )
+    apBoot.add_argument(
+        "--remove-class",
+        action="append",
+        choices=bootClasses,
+        help="delete all boot options of this kind; may be repeated",
+    )
+    apBoot.add_argument(
+        "--add",
+        action="append",
+        help="add a boot option given as NNNN=HEX (an EFI_LOAD_OPTION); may be "
+        "repeated",
+    )
+    apBoot.set_defaults(func=cmdBoot)
+
+    addPathArguments(apReclaim, "compact")
+    apReclaim.add_argument(
+        "--dry-run",
+        "-n",
+        action="store_true",
+        help="only report how much space would be reclaimed",
+    )
+    apReclaim.set_defaults(func=cmdReclaim)
+
+    addPathArguments(apScan, "search")
+    apScan.add_argument("--vendor", help="only match this vendor GUID (name or UUID)")
+    apScan.add_argument("--name", help="only match variables with this name")
+    apScan.add_argument(
+        "--flags",
+        type=lambda x: int(x, 0),
+        help="only match variables with all of these attribute flags set",
+    )
+    apScan.add_argument(
+        "--data-len", type=int, help="only match variables with this data length"
+    )
+    apScan.add_argument("--data", help="only match variables with this data (hex)")
+    apScan.add_argument(
+        "--deleted", "-d", action="store_true", help="also match deleted variables"
+    )
+    apScan.add_argument(
+        "--chunk-size",
+        type=int,
+        default=64,
+        help="number of files handed to a worker at a time (default: %(default)s)",
+    )
+    apScan.set_defaults(func=cmdScan)
+
+    addPathArguments(apVerify, "check", jobs=False)
+    apVerify.set_defaults(func=cmdVerify)
+
+    addPathArguments(apRecover, "repair")
+    apRecover.add_argument(
+        "--dry-run",
+        "-n",
+        action="store_true",
+        help="only report what would be done",
+    )
+    apRecover.set_defaults(func=cmdRecover)
+
+    addPathArguments(apSignatures, "search")
+    apSignatures.add_argument(
+        "--var",
+        action="append",
+        help="only look in this variable (PK, KEK, db, dbx, ...); may be repeated",
+    )
+    apSignatures.add_argument(
+        "--check",
+        action="append",
+        help="only print entries matching this hash or certificate fingerprint "
+        "(hex); may be repeated",
+    )
+    apSignatures.add_argument(
+        "--check-file",
+        help="file of hashes to check for, one hex value per line",
+    )
+    apSignatures.set_defaults(func=cmdSignatures)
+
+    subapCatalog = apCatalog.add_subparsers(help="catalog subcommands")
+    apCatalogIngest = subapCatalog.add_parser(
+        "ingest", help="Add new or changed OVMF_VARS.fd files to the catalog"
+    )
+    apCatalogIngest.add_argument("database", help="SQLite catalog file")
+    addPathArguments(apCatalogIngest, "ingest", jobs=False)
+    apCatalogIngest.add_argument(
+        "--prune",
+        action="store_true",
+        help="remove catalog entries for files which no longer exist",
+    )
+    apCatalogIngest.set_defaults(func=cmdCatalogIngest)
+
+    apCatalogQuery = subapCatalog.add_parser(
+        "query", help="Run an SQL query against the catalog"
+    )
+    apCatalogQuery.add_argument("database", help="SQLite catalog file")
+    apCatalogQuery.add_argument("sql", help="SQL query to run")
+    apCatalogQuery.add_argument("param", nargs="*", help="query parameters")
+    apCatalogQuery.set_defaults(func=cmdCatalogQuery)
+
+    apServe.add_argument("--socket", "-s", required=True, help="Unix socket to listen on")
+    apServe.add_argument(
+        "--cache-size",
+        type=int,
+        default=256,
+        help="maximum number of parsed files to keep (default: %(default)s)",
+    )
+    apServe.set_defaults(func=cmdServe)
+
+    apClient.add_argument(
+        "--socket", "-s", required=True, help="Unix socket the daemon listens on"
+    )
+    apClient.add_argument("op", choices=("list", "get", "export"), help="query type")
+    apClient.add_argument("vars-file", help="OVMF_VARS.fd file to query")
+    apClient.add_argument("vendor", nargs="?", help="vendor GUID for get")
+    apClient.add_argument("name", nargs="?", help="variable name for get")
+    apClient.set_defaults(func=cmdClient)
+
     args = vars(ap.parse_args())
     if not args.get("func"):
         ap.print_usage()
         return 1
 
+    for path in args.get("guid_db") or ():
+        addGuidDatabase(path)
+
     return args["func"](args)
 
     doc = dict(Variables={})